@@ -0,0 +1,239 @@
+import asyncio
+import hashlib
+import itertools
+import json
+import os
+import random
+import time
+from io import BytesIO
+
+from aiohttp import web
+from PIL import Image
+
+WORDS = (
+    "midnight summer electric golden broken silent velvet neon paper crystal "
+    "river city heart dream fire ocean shadow light road train garden echo"
+).split()
+NAMES = "nova arctic luna static orbit kite ember drift atlas violet".split()
+
+
+def make_catalog(size, seed=0):
+    # Deterministic set of (artists, title) pairs the fake search knows
+    rnd = random.Random(seed)
+    catalog = []
+    seen = set()
+    while len(catalog) < size:
+        title = " ".join(rnd.sample(WORDS, rnd.randint(2, 3))).title()
+        artists = " ".join(rnd.sample(NAMES, 2)).title()
+        if (artists, title) not in seen:
+            seen.add((artists, title))
+            catalog.append((artists, title))
+    return catalog
+
+
+def fake_download(yt_link, outtmpl, formats, codec, quality):
+    # Stands in for download_audio in the download pool, the duration and
+    # size come from the environment inherited from the benchmark
+    time.sleep(float(os.environ.get("BENCH_DOWNLOAD_TIME", "0.5")))
+    path = f"{outtmpl}.m4a"
+    with open(path, "wb") as f:
+        f.write(os.urandom(int(os.environ.get("BENCH_DOWNLOAD_SIZE", "65536"))))
+    return path, "passthrough", 0.0, 0.0
+
+
+def fake_check(yt_link):
+    # Stands in for check_video in the link check pool, a few links in a
+    # hundred are dead, always the same ones
+    time.sleep(float(os.environ.get("BENCH_CHECK_TIME", "0.05")))
+    return hashlib.md5(yt_link.encode()).digest()[0] >= 8
+
+
+class FakeServices:
+    # One local web server standing in for the Bot API, Yandex Music search
+    # (and its covers) and the YouTube Data API. Bot API messages are kept
+    # per chat, so simulated users can read the buttons they were sent.
+    def __init__(
+        self,
+        catalog,
+        telegram_latency=0.03,
+        upload_latency=0.2,
+        api_latency=0.1,
+        flood_limit=0,
+    ):
+        self.catalog = {
+            title.casefold(): (artists, title) for artists, title in catalog
+        }
+        self.telegram_latency = telegram_latency
+        self.upload_latency = upload_latency
+        self.api_latency = api_latency
+        self.flood_limit = flood_limit
+        self.recent = {}
+        self.message_ids = {}
+        self.messages = {}
+        self.file_ids = itertools.count()
+        self.requests = {}
+        self.runner = None
+        self.url = None
+        cover = BytesIO()
+        Image.new("RGB", (300, 300), "#3d5a80").save(cover, format="JPEG")
+        self.cover = cover.getvalue()
+
+    async def start(self):
+        app = web.Application(client_max_size=64 << 20)
+        app.router.add_post("/bot{token}/{method}", self.bot_api)
+        app.router.add_get("/handlers/music-search.jsx", self.music_search)
+        app.router.add_get("/cover/{id}/{size}", self.cover_image)
+        app.router.add_get("/youtube/v3/search", self.youtube_search)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]  # type: ignore
+        self.url = f"http://127.0.0.1:{port}"
+
+    async def stop(self):
+        await self.runner.cleanup()  # type: ignore
+
+    def count(self, name):
+        self.requests[name] = self.requests.get(name, 0) + 1
+
+    def next_message_id(self, chat_id):
+        self.message_ids[chat_id] = self.message_ids.get(chat_id, 0) + 1
+        return self.message_ids[chat_id]
+
+    def last_message(self, chat_id):
+        messages = self.messages.get(chat_id)
+        return messages[max(messages)] if messages else None
+
+    async def bot_api(self, request):
+        method = request.match_info["method"]
+        self.count(method)
+        data = dict(await request.post())
+        if "chat_id" in data and self.flooded(int(data["chat_id"])):
+            self.count("flood_errors")
+            return web.json_response(
+                {
+                    "ok": False,
+                    "error_code": 429,
+                    "description": "Too Many Requests: retry after 1",
+                    "parameters": {"retry_after": 1},
+                },
+                status=429,
+            )
+        await asyncio.sleep(
+            self.upload_latency if method == "sendAudio" else self.telegram_latency
+        )
+        if method in ("sendPhoto", "sendMessage", "sendAudio"):
+            chat_id = int(data["chat_id"])
+            message = {
+                "message_id": self.next_message_id(chat_id),
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "from": {"id": 1, "is_bot": True, "first_name": "bot"},
+            }
+            if method == "sendAudio":
+                file_id = f"audio{next(self.file_ids)}"
+                message["audio"] = {
+                    "file_id": file_id,
+                    "file_unique_id": file_id,
+                    "duration": 180,
+                }
+            elif method == "sendPhoto":
+                message["photo"] = [self.photo()]
+            else:
+                message["text"] = data.get("text", "")
+            self.update(message, data)
+            self.messages.setdefault(chat_id, {})[message["message_id"]] = message
+            return self.result(message)
+        if method.startswith("edit"):
+            chat_id, message_id = int(data["chat_id"]), int(data["message_id"])
+            message = dict(self.messages[chat_id][message_id])
+            message["edit_date"] = int(time.time())
+            if method == "editMessageMedia":
+                media = json.loads(data["media"])
+                # Photos sent by file_id keep it, like on Telegram
+                if media["media"].startswith("photo"):
+                    file_id = media["media"]
+                    message["photo"] = [
+                        {**self.photo(), "file_id": file_id, "file_unique_id": file_id}
+                    ]
+                else:
+                    message["photo"] = [self.photo()]
+                message.pop("caption", None)
+                if "caption" in media:
+                    message["caption"] = media["caption"]
+            self.update(message, data, edit=True)
+            self.messages[chat_id][message_id] = message
+            return self.result(message)
+        return self.result(True)
+
+    def flooded(self, chat_id):
+        # More than flood_limit requests to a chat within a second are
+        # refused, like Telegram's flood control does
+        if not self.flood_limit:
+            return False
+        now = time.monotonic()
+        recent = self.recent.setdefault(chat_id, [])
+        recent[:] = [t for t in recent if now - t < 1]
+        if len(recent) >= self.flood_limit:
+            return True
+        recent.append(now)
+        return False
+
+    def photo(self):
+        file_id = f"photo{next(self.file_ids)}"
+        return {
+            "file_id": file_id,
+            "file_unique_id": file_id,
+            "width": 300,
+            "height": 300,
+        }
+
+    def update(self, message, data, edit=False):
+        if "caption" in data:
+            message["caption"] = data["caption"]
+        if "reply_markup" in data:
+            markup = json.loads(data["reply_markup"])
+            if "inline_keyboard" in markup:
+                message["reply_markup"] = markup
+            else:
+                message.pop("reply_markup", None)
+        elif edit:
+            # Edits without a keyboard remove it, like Telegram does
+            message.pop("reply_markup", None)
+
+    def result(self, result):
+        return web.json_response({"ok": True, "result": result})
+
+    async def music_search(self, request):
+        self.count("music-search")
+        await asyncio.sleep(self.api_latency)
+        text = request.query["text"].casefold()
+        track = self.catalog.get(text)
+        if track is None:
+            return web.json_response({"tracks": {"items": []}})
+        artists, title = track
+        track_id = hashlib.sha1(title.encode()).hexdigest()[:8]
+        host = self.url.split("://", 1)[1]  # type: ignore
+        item = {
+            "title": title,
+            "artists": [{"name": name} for name in artists.split()],
+            "coverUri": f"{host}/cover/{track_id}/%%",
+            "durationMs": 180000,
+        }
+        return web.json_response({"tracks": {"items": [item]}})
+
+    async def cover_image(self, request):
+        self.count("cover")
+        return web.Response(body=self.cover, content_type="image/jpeg")
+
+    async def youtube_search(self, request):
+        self.count("youtube-search")
+        await asyncio.sleep(self.api_latency)
+        query = request.query["q"]
+        video_id = hashlib.sha1(query.encode()).hexdigest()[:11]
+        item = {
+            "id": {"kind": "youtube#video", "videoId": video_id},
+            "snippet": {"title": query},
+        }
+        return web.json_response({"items": [item]})
@@ -0,0 +1,366 @@
+import argparse
+import asyncio
+import itertools
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+
+from .fakes import FakeServices, fake_check, fake_download, make_catalog
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+def quantile(samples, q):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+
+def histogram_quantile(histogram, q, **labels):
+    # Upper bound of the bucket the quantile falls in, like Prometheus'
+    # histogram_quantile without the interpolation
+    series = histogram.series.get(histogram.key(labels))
+    if series is None:
+        return None
+    counts, _, count = series
+    cumulative = 0
+    for bound, observations in zip((*histogram.buckets, float("inf")), counts):
+        cumulative += observations
+        if cumulative >= q * count:
+            return bound
+    return float("inf")
+
+
+class Recorder:
+    # Keeps every handler duration, the Prometheus histograms only keep
+    # buckets. Nothing from aiogram is imported at the top of this module,
+    # the download workers import it again when they start.
+    def __init__(self):
+        self.samples = defaultdict(list)
+        self.errors = Counter()
+
+    async def __call__(self, handler, event, data):
+        name = data["handler"].callback.__name__
+        start = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            self.errors[name] += 1
+            raise
+        finally:
+            self.samples[name].append(time.perf_counter() - start)
+
+
+class User:
+    # A simulated user talking to the dispatcher the way polling would feed
+    # it, reading the bot's replies from the fake Bot API
+    def __init__(self, bench, user_id):
+        self.bench = bench
+        self.id = user_id
+        self.playlists = 0
+
+    def sender(self):
+        return {"id": self.id, "is_bot": False, "first_name": f"user{self.id}"}
+
+    async def feed(self, step, update):
+        from aiogram.types import Update
+
+        dp, bot = self.bench.dp, self.bench.bot
+        update = Update.model_validate(
+            {"update_id": next(self.bench.update_ids), **update}, context={"bot": bot}
+        )
+        start = time.perf_counter()
+        try:
+            await dp.feed_update(bot, update)
+        except Exception as e:
+            self.bench.errors[step, type(e).__name__] += 1
+        self.bench.steps[step].append(time.perf_counter() - start)
+
+    async def send(self, step, text):
+        message = {
+            "message_id": self.bench.fake.next_message_id(self.id),
+            "date": int(time.time()),
+            "chat": {"id": self.id, "type": "private"},
+            "from": self.sender(),
+            "text": text,
+        }
+        await self.feed(step, {"message": message})
+
+    def buttons(self):
+        message = self.bench.fake.last_message(self.id)
+        if message is None or "reply_markup" not in message:
+            return message, []
+        return message, [
+            button
+            for row in message["reply_markup"]["inline_keyboard"]
+            for button in row
+        ]
+
+    async def click(self, step, text=None, choose=None):
+        # Presses the button with the given text on the bot's last message,
+        # or one picked by choose from all of them. Returns False if there
+        # was none.
+        message, buttons = self.buttons()
+        if choose is not None:
+            buttons = choose(buttons)
+        else:
+            buttons = [button for button in buttons if button["text"] == text]
+        if not buttons:
+            return False
+        query = {
+            "id": str(next(self.bench.update_ids)),
+            "from": self.sender(),
+            "chat_instance": str(self.id),
+            "message": message,
+            "data": buttons[0]["callback_data"],
+        }
+        await self.feed(step, {"callback_query": query})
+        return True
+
+    async def session(self, rnd):
+        await self.send("library", "My library")
+        if self.playlists < 2:
+            await self.click("new_playlist", "Create new playlist")
+            self.playlists += 1
+            await self.send("create_playlist", f"Mix {self.id} {self.playlists}")
+        # Page through a playlist and back
+        if await self.click("show_playlist", choose=playlist_buttons):
+            for _ in range(rnd.randint(0, 3)):
+                if not await self.click("page_tracks", "➡️"):
+                    break
+            await self.click("close_playlist", "Go back")
+        await self.send("search", "Track search")
+        await self.send("search_track", self.bench.query(rnd))
+        if await self.click("add", "Add to playlist"):
+            await self.click("add_to_playlist", choose=playlist_buttons)
+        await self.click("download", "Download")
+
+    async def run(self, sessions, seed):
+        rnd = random.Random(seed)
+        await self.send("start", "/start")
+        for _ in range(sessions):
+            await self.session(rnd)
+
+
+def playlist_buttons(buttons):
+    return [
+        button
+        for button in buttons
+        if button["text"]
+        not in ("⬅️", "➡️", "Go back", "Cancel", "Create new playlist")
+    ]
+
+
+class Bench:
+    def __init__(self, args):
+        self.args = args
+        self.catalog = make_catalog(args.catalog)
+        # Popular tracks are searched much more often than the rest
+        self.weights = [1 / rank for rank in range(1, len(self.catalog) + 1)]
+        self.fake = FakeServices(
+            self.catalog,
+            args.telegram_latency,
+            args.upload_latency,
+            args.api_latency,
+            args.flood_limit,
+        )
+        self.update_ids = itertools.count(1)
+        self.steps = defaultdict(list)
+        self.errors = Counter()
+        self.recorder = Recorder()
+        self.dp = None
+        self.bot = None
+
+    def query(self, rnd):
+        _, title = rnd.choices(self.catalog, self.weights)[0]
+        query = title.lower()
+        if rnd.random() < self.args.typos:
+            i = rnd.randrange(len(query))
+            query = query[:i] + rnd.choice("aeiou") + query[i + 1 :]
+        return query
+
+    async def start(self):
+        await self.fake.start()
+        os.environ.update(
+            {
+                "TELEGRAM_API_URL": self.fake.url,
+                "YANDEX_MUSIC_URL": self.fake.url,
+                "YT_API_URL": f"{self.fake.url}/youtube/v3/",
+            }
+        )
+        # The bot reads its settings on import, so it's only imported once
+        # the fake services are listening
+        from handlers import base
+        from handlers.startup import include_routers
+
+        self.dp, self.bot = base.dp, base.bot
+        include_routers(self.dp)
+        base.downloader.download = fake_download
+        base.link_checker.check_video = fake_check
+        self.dp.message.middleware(self.recorder)
+        self.dp.callback_query.middleware(self.recorder)
+        await self.dp.emit_startup(bot=self.bot)
+
+    async def stop(self):
+        await self.dp.emit_shutdown(bot=self.bot)
+        await self.bot.session.close()
+        await self.fake.stop()
+
+    async def run(self):
+        users = [User(self, 1000 + i) for i in range(self.args.users)]
+        start = time.perf_counter()
+        await asyncio.gather(
+            *(
+                user.run(self.args.sessions, self.args.seed + i)
+                for i, user in enumerate(users)
+            )
+        )
+        return time.perf_counter() - start
+
+    def report(self, elapsed):
+        from handlers import metrics
+
+        updates = sum(len(samples) for samples in self.steps.values())
+        print(
+            f"{self.args.users} users x {self.args.sessions} sessions: "
+            f"{updates} updates in {elapsed:.2f}s, "
+            f"{updates / elapsed:.1f} updates/s, "
+            f"{self.args.users * self.args.sessions / elapsed:.2f} sessions/s"
+        )
+        print()
+        header = f"{'':28} {'count':>7} {'errors':>7}" + "".join(
+            f" {f'p{int(q * 100)} ms':>9}" for q in QUANTILES
+        )
+        for title, samples, errors in (
+            ("handler", self.recorder.samples, self.recorder.errors),
+            ("user step", self.steps, self.step_errors()),
+        ):
+            print(header.replace(" " * 28, f"{title:28}", 1))
+            for name, durations in sorted(samples.items()):
+                print(
+                    f"{name:28} {len(durations):7} {errors[name]:7}"
+                    + "".join(
+                        f" {quantile(durations, q) * 1000:9.1f}" for q in QUANTILES
+                    )
+                )
+            print()
+        print("database (percentiles are histogram bucket bounds)")
+        for kind in ("read", "write"):
+            series = metrics.DB_SECONDS.series.get((kind,))
+            if series is None:
+                continue
+            _, total, count = series
+            p95 = histogram_quantile(metrics.DB_SECONDS, 0.95, kind=kind)
+            print(
+                f"  {kind + 's':8} {count:7}  mean {total / count * 1000:7.2f} ms"
+                f"  p95 <= {p95 * 1000:g} ms"
+            )
+        commits = metrics.DB_COMMIT_SECONDS.series.get(())
+        batches = metrics.DB_BATCH_SIZE.series.get(())
+        if commits is not None and batches is not None:
+            p95 = histogram_quantile(metrics.DB_BATCH_SIZE, 0.95)
+            print(
+                f"  commits  {commits[2]:7}"
+                f"  mean {commits[1] / commits[2] * 1000:7.2f} ms"
+                f"  mean batch {batches[1] / batches[2]:.1f} writes"
+                f"  p95 batch <= {p95:g}"
+            )
+        for title, counter in (
+            ("prefetches", metrics.PREFETCHES),
+            ("link checks", metrics.LINK_CHECKS),
+        ):
+            if counter.series:
+                print()
+                print(title)
+                for (result,), count in sorted(counter.series.items()):
+                    print(f"  {result:28} {count:7}")
+        print()
+        print("requests to fake services")
+        for name, count in sorted(self.fake.requests.items()):
+            print(f"  {name:28} {count:7}")
+        if self.errors:
+            print()
+            print("errors")
+            for (step, error), count in sorted(self.errors.items()):
+                print(f"  {step:20} {error:28} {count:5}")
+
+    def step_errors(self):
+        errors = Counter()
+        for (step, _), count in self.errors.items():
+            errors[step] += count
+        return errors
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Replays scripted user sessions against fake Telegram, "
+        "Yandex Music and YouTube servers and reports handler latencies"
+    )
+    add = parser.add_argument
+    add("--users", type=int, default=20, help="concurrent users")
+    add("--sessions", type=int, default=5, help="sessions per user")
+    add("--catalog", type=int, default=200, help="tracks the fake search knows")
+    add("--typos", type=float, default=0.1, help="share of misspelled searches")
+    add("--telegram-latency", type=float, default=0.03, help="seconds per request")
+    add("--upload-latency", type=float, default=0.2, help="seconds per audio upload")
+    add("--api-latency", type=float, default=0.1, help="seconds per search request")
+    add(
+        "--flood-limit",
+        type=int,
+        default=0,
+        help="Bot API requests per chat and second before flood errors, 0 for none",
+    )
+    add("--download-time", type=float, default=0.5, help="seconds per download")
+    add(
+        "--link-check-interval",
+        type=float,
+        default=1,
+        help="seconds between batches of link checks, 0 disables them",
+    )
+    add("--seed", type=int, default=0)
+    add("--keep", action="store_true", help="keep the working directory")
+    return parser.parse_args()
+
+
+async def main(args):
+    bench = Bench(args)
+    await bench.start()
+    try:
+        elapsed = await bench.run()
+    finally:
+        await bench.stop()
+    bench.report(elapsed)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    # The bot keeps its database and caches relative to the working
+    # directory, so it runs in a scratch copy of data/ with the images only
+    workdir = tempfile.mkdtemp(prefix="bench-")
+    os.makedirs(os.path.join(workdir, "data", "db"))
+    os.symlink(
+        os.path.join(ROOT, "data", "img"), os.path.join(workdir, "data", "img")
+    )
+    os.chdir(workdir)
+    sys.path.insert(0, ROOT)
+    os.environ.update(
+        {
+            "BOT_TOKEN": "123456:bench",
+            "YT_TOKEN": "bench",
+            "DB_PATH": os.path.join(workdir, "data", "db", "music.db"),
+            "YT_DAILY_QUOTA": str(10**9),
+            "BENCH_DOWNLOAD_TIME": str(args.download_time),
+            "LINK_CHECK_INTERVAL": str(args.link_check_interval),
+        }
+    )
+    try:
+        asyncio.run(main(args))
+    finally:
+        if args.keep:
+            print(f"\nworking directory: {workdir}")
+        else:
+            shutil.rmtree(workdir)
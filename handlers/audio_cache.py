@@ -0,0 +1,122 @@
+import asyncio
+import os
+import time
+import uuid
+from collections import Counter
+from contextlib import suppress
+
+from .repository import (
+    add_audio_file,
+    get_audio_cache_size,
+    get_audio_file,
+    get_audio_files,
+    get_oldest_audio_files,
+    remove_audio_file,
+    touch_audio_file,
+)
+
+
+class AudioCache:
+    # Downloaded tracks are stored as <track_id>.<format> and indexed in the
+    # AudioFiles table. Downloads are written to tmp/ first and renamed into
+    # place, so a file in the cache directory is always complete. Files that
+    # are being sent are pinned and skipped by the LRU eviction. Pins are
+    # per process, so files used in the last grace seconds are skipped too in
+    # case another process sharing the directory is still sending them.
+    def __init__(self, directory, max_bytes, grace=600):
+        self.directory = directory
+        self.tmp_directory = os.path.join(directory, "tmp")
+        self.max_bytes = max_bytes
+        self.grace = grace
+        self.pins = Counter()
+
+    def path(self, track_id, fmt):
+        return os.path.join(self.directory, f"{track_id}.{fmt}")
+
+    def tmp_template(self):
+        return os.path.join(self.tmp_directory, uuid.uuid4().hex)
+
+    def pin(self, path):
+        self.pins[path] += 1
+
+    def unpin(self, path):
+        self.pins[path] -= 1
+        if self.pins[path] <= 0:
+            del self.pins[path]
+
+    async def start(self):
+        os.makedirs(self.tmp_directory, exist_ok=True)
+        await asyncio.to_thread(self.remove_stale_tmp_files)
+        indexed = set()
+        for track_id, fmt in await get_audio_files():
+            path = self.path(track_id, fmt)
+            if os.path.isfile(path):
+                indexed.add(os.path.basename(path))
+            else:
+                await remove_audio_file(track_id, fmt)
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and entry.name not in indexed:
+                # Another process may have just moved it in and not yet
+                # indexed it
+                with suppress(FileNotFoundError):
+                    if entry.stat().st_mtime < time.time() - self.grace:
+                        os.remove(entry.path)
+        await self.evict()
+
+    def remove_stale_tmp_files(self, age=3600):
+        # Leftovers of interrupted downloads, recent files may still be
+        # written to by another worker
+        for entry in os.scandir(self.tmp_directory):
+            if entry.stat().st_mtime < time.time() - age:
+                with suppress(FileNotFoundError):
+                    os.remove(entry.path)
+
+    async def contains(self, track_id):
+        return await get_audio_file(track_id) is not None
+
+    async def get(self, track_id):
+        row = await get_audio_file(track_id)
+        if row is None:
+            return None
+        fmt = row[0]
+        path = self.path(track_id, fmt)
+        self.pin(path)
+        # Touched before checking the file, so other processes stop
+        # considering it for eviction as early as possible
+        await touch_audio_file(track_id, fmt, time.time())
+        if not os.path.isfile(path):
+            self.unpin(path)
+            await remove_audio_file(track_id, fmt)
+            return None
+        return path
+
+    async def put(self, track_id, fmt, tmp_path):
+        path = self.path(track_id, fmt)
+        size = os.path.getsize(tmp_path)
+        os.replace(tmp_path, path)
+        self.pin(path)
+        await add_audio_file(track_id, fmt, size, time.time())
+        await self.evict()
+        return path
+
+    async def evict(self):
+        size = await get_audio_cache_size()
+        # Pinned files stay in the index, the rows after them are read past
+        pinned = 0
+        while size > self.max_bytes:
+            rows = await get_oldest_audio_files(64, time.time() - self.grace, pinned)
+            if not rows:
+                break
+            candidates = [
+                (track_id, fmt, file_size)
+                for track_id, fmt, file_size in rows
+                if self.path(track_id, fmt) not in self.pins
+            ]
+            pinned += len(rows) - len(candidates)
+            for track_id, fmt, file_size in candidates:
+                with suppress(FileNotFoundError):
+                    os.remove(self.path(track_id, fmt))
+                await remove_audio_file(track_id, fmt)
+                size -= file_size
+                if size <= self.max_bytes:
+                    break
@@ -1,16 +1,32 @@
-import sqlite3
+import time
+from functools import partial
+from math import ceil
 from os import getenv
 
-import aiohttp
-from aiogram import Bot, Dispatcher, html
+from aiogram import Bot, Dispatcher, Router, html
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 from aiogram.enums import ParseMode
+from aiogram.exceptions import TelegramBadRequest
 from aiogram.filters import CommandStart
 from aiogram.filters.callback_data import CallbackData
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.types import FSInputFile, Message
+from aiogram.types import FSInputFile, InputMediaPhoto, Message
 from aiogram.utils.keyboard import ReplyKeyboardBuilder
-from pyyoutube import Api
+
+from .audio_cache import AudioCache
+from .cache import QueryCache, SharedLRUCache, SingleFlight
+from .covers import CoverCache
+from .downloads import Downloader
+from .fsm import create_storage
+from .http import HttpClient
+from .index import TrackIndex
+from .link_checks import LinkChecker
+from .metrics import Gauge, HandlerMetrics, RequestMetrics
+from .outbound import PRIORITIES, OutboundScheduler
+from .youtube import LinkResolver
+from .repository import *
 
 
 class Callback(CallbackData, prefix="button", sep="^"):
@@ -24,51 +40,309 @@ class States(StatesGroup):
     track_name = State()
 
 
-def init_db():
-    sql = "CREATE TABLE IF NOT EXISTS Users (id INTEGER UNIQUE, playlists TEXT)"
-    cur.execute(sql)
-    sql = "CREATE TABLE IF NOT EXISTS Playlists (id INTEGER PRIMARY KEY, name TEXT, logo BLOB, tracks TEXT)"
-    cur.execute(sql)
-    sql = "CREATE TABLE IF NOT EXISTS Tracks (id INTEGER PRIMARY KEY, title TEXT, artists TEXT, cover_link TEXT, yt_link TEXT)"
-    cur.execute(sql)
-    con.commit()
+def page_anchors(total, page, rows):
+    # Callback data for the arrows of a page: the target page and the
+    # position to continue from, the last page wraps around to the first one
+    pages = ceil(total / PAGE_SIZE)
+    if page == 0:
+        left = f"{pages - 1} -"
+    else:
+        left = f"{page - 1} <{rows[0][-1]}"
+    if page == pages - 1:
+        right = "0 -"
+    else:
+        right = f"{page + 1} >{rows[-1][-1]}"
+    return left, right
+
+
+def is_file_id_error(e):
+    # Telegram doesn't know the stored file_id (any more), as opposed to
+    # errors about the chat or the message
+    message = e.message.lower()
+    return "file identifier" in message or "file_id" in message
 
 
 async def get_json_response(url, params=None):
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url, params=params) as resp:
-            if not resp.ok:
-                return None
-            return await resp.json()
+    return await http.get(url, params=params, kind="json")
 
 
 async def get_text_response(url, params=None):
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url, params=params) as resp:
-            if not resp.ok:
-                return None
-            return await resp.text()
+    return await http.get(url, params=params, kind="text")
+
+
+async def get_bytes_response(url, params=None):
+    return await http.get(url, params=params, kind="bytes")
+
+
+async def sync_track_index():
+    # Tracks stored by other bot processes are picked up by id, tracks
+    # stored by this one are added as they are stored
+    for track in await get_tracks_after(track_index.last_id):
+        track_index.add(*track)
+    track_index.synced_at = time.monotonic()
+
+
+def link_checks_busy():
+    # Link checks give way to downloads and to searches waiting for a slot
+    return bool(
+        downloader.queue_depth or downloader.active or link_resolver.semaphore.locked()
+    )
+
+
+async def edit_photo(message, file_id, load, store, caption=None, reply_markup=None):
+    # Shows a picture on the message by its stored file_id, or the one
+    # load() returns if there is none. store() is given the photo Telegram
+    # made of an upload, or None when the stored file_id is no longer valid
+    # and the picture is uploaded again.
+    media = file_id if file_id is not None else await load()
+    try:
+        msg = await message.edit_media(
+            InputMediaPhoto(media=media, caption=caption), reply_markup=reply_markup
+        )
+    except TelegramBadRequest as e:
+        if "not modified" in e.message:
+            return message
+        if file_id is None or not is_file_id_error(e):
+            raise
+        await store(None)
+        return await edit_photo(message, None, load, store, caption, reply_markup)
+    # An edit replaced by a later one of the same message returns True
+    if file_id is None and isinstance(msg, Message) and msg.photo:
+        await store(msg.photo[-1])
+    return msg
+
+
+async def edit_track_cover(
+    message, track_id, cover_link, cover_file_id, caption=None, reply_markup=None
+):
+    async def store(photo):
+        await set_track_cover_file_id(track_id, photo and photo.file_id)
+
+    return await edit_photo(
+        message,
+        cover_file_id,
+        partial(covers.get, track_id, cover_link),
+        store,
+        caption,
+        reply_markup,
+    )
 
 
 BOT_TOKEN = getenv("BOT_TOKEN")
 YT_TOKEN = getenv("YT_TOKEN")
+DOWNLOAD_WORKERS = int(getenv("DOWNLOAD_WORKERS", "2"))
+AUDIO_CACHE_SIZE = int(getenv("AUDIO_CACHE_SIZE", str(1 << 30)))
+AUDIO_FORMATS = getenv("AUDIO_FORMATS", "m4a,mp3").split(",")
+AUDIO_CODEC = getenv("AUDIO_CODEC", "mp3")
+AUDIO_QUALITY = getenv("AUDIO_QUALITY", "192")
+PREFETCH_DOWNLOADS = int(getenv("PREFETCH_DOWNLOADS", "0"))
+PREFETCH_BUDGET = int(getenv("PREFETCH_BUDGET", str(1 << 28)))
+PREFETCH_TTL = int(getenv("PREFETCH_TTL", "600"))
+KEYBOARD_CACHE_SIZE = int(getenv("KEYBOARD_CACHE_SIZE", "1024"))
+HTTP_TIMEOUT = float(getenv("HTTP_TIMEOUT", "10"))
+HTTP_RETRIES = int(getenv("HTTP_RETRIES", "2"))
+HTTP_LIMIT_PER_HOST = int(getenv("HTTP_LIMIT_PER_HOST", "10"))
+LOCAL_SEARCH_SCORE = int(getenv("LOCAL_SEARCH_SCORE", "85"))
+SEARCH_CANDIDATES = int(getenv("SEARCH_CANDIDATES", "5"))
+VIDEO_MATCH_SCORE = int(getenv("VIDEO_MATCH_SCORE", "60"))
+PICK_MARGIN = float(getenv("PICK_MARGIN", "10"))
+SEARCH_CACHE_SIZE = int(getenv("SEARCH_CACHE_SIZE", "1024"))
+SEARCH_CACHE_TTL = int(getenv("SEARCH_CACHE_TTL", "86400"))
+SEARCH_CACHE_NEGATIVE_TTL = int(getenv("SEARCH_CACHE_NEGATIVE_TTL", "600"))
+YT_LINK_CACHE_TTL = int(getenv("YT_LINK_CACHE_TTL", "2592000"))
+YT_DAILY_QUOTA = int(getenv("YT_DAILY_QUOTA", "10000"))
+YT_SEARCH_CONCURRENCY = int(getenv("YT_SEARCH_CONCURRENCY", "2"))
+LINK_CHECK_INTERVAL = float(getenv("LINK_CHECK_INTERVAL", "60"))
+LINK_CHECK_BATCH = int(getenv("LINK_CHECK_BATCH", "20"))
+LINK_CHECK_CONCURRENCY = int(getenv("LINK_CHECK_CONCURRENCY", "2"))
+LINK_CHECK_AGE = int(getenv("LINK_CHECK_AGE", "604800"))
+LINK_CHECK_RETRY = int(getenv("LINK_CHECK_RETRY", "3600"))
+LINK_CHECK_FAILURES = int(getenv("LINK_CHECK_FAILURES", "2"))
+COVER_CACHE_SIZE = int(getenv("COVER_CACHE_SIZE", "0"))
+LOGO_SOURCE = getenv("LOGO_SOURCE", "local")
+FSM_STORAGE = getenv("FSM_STORAGE", "sqlite")
+METRICS_PORT = int(getenv("METRICS_PORT", "0"))
+TRACE_LOG = getenv("TRACE_LOG", "0") == "1"
+TELEGRAM_API_URL = getenv("TELEGRAM_API_URL")
+YANDEX_MUSIC_URL = getenv("YANDEX_MUSIC_URL", "https://music.yandex.ru")
+YT_API_URL = getenv("YT_API_URL")
+INLINE_PAGE_SIZE = int(getenv("INLINE_PAGE_SIZE", "20"))
+INLINE_CACHE_TIME = int(getenv("INLINE_CACHE_TIME", "300"))
+INLINE_SYNC_INTERVAL = float(getenv("INLINE_SYNC_INTERVAL", "30"))
+TELEGRAM_RATE_LIMIT = float(getenv("TELEGRAM_RATE_LIMIT", "30"))
+TELEGRAM_CHAT_RATE_LIMIT = float(getenv("TELEGRAM_CHAT_RATE_LIMIT", "1"))
+TELEGRAM_CHAT_BURST = int(getenv("TELEGRAM_CHAT_BURST", "4"))
+TELEGRAM_RETRIES = int(getenv("TELEGRAM_RETRIES", "3"))
+WEBHOOK_URL = getenv("WEBHOOK_URL")
+WEBHOOK_PATH = getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = getenv("WEBHOOK_SECRET")
+WEBHOOK_HOST = getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_SHUTDOWN_TIMEOUT = float(getenv("WEBHOOK_SHUTDOWN_TIMEOUT", "30"))
 
 library_img = FSInputFile("data/img/library.png", "library.png")
 waiting_img = FSInputFile("data/img/waiting.png", "waiting.png")
 error_img = FSInputFile("data/img/error.png", "error.png")
 
-con = sqlite3.connect("data/db/music.db")
-cur = con.cursor()
-init_db()
-dp = Dispatcher()
-bot = Bot(token=BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))  # type: ignore
-yt_api = Api(api_key=YT_TOKEN)
+dp = Dispatcher(storage=create_storage(FSM_STORAGE))
+router = Router(name=__name__)
+session = None
+if TELEGRAM_API_URL:
+    session = AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL))
+bot = Bot(
+    token=BOT_TOKEN,  # type: ignore
+    session=session,
+    default=DefaultBotProperties(parse_mode=ParseMode.HTML),
+)
+audio_cache = AudioCache("data/cache/audio", AUDIO_CACHE_SIZE)
+downloader = Downloader(
+    audio_cache,
+    DOWNLOAD_WORKERS,
+    AUDIO_FORMATS,
+    AUDIO_CODEC,
+    AUDIO_QUALITY,
+    PREFETCH_DOWNLOADS,
+    PREFETCH_BUDGET,
+    PREFETCH_TTL,
+)
+keyboards = SharedLRUCache(
+    KEYBOARD_CACHE_SIZE, get_cache_revision, bump_cache_revision
+)
+http = HttpClient(
+    limit_per_host=HTTP_LIMIT_PER_HOST, timeout=HTTP_TIMEOUT, retries=HTTP_RETRIES
+)
+metadata_cache = QueryCache(
+    partial(load_cached, "SearchCache"),
+    partial(store_cached, "SearchCache"),
+    SEARCH_CACHE_SIZE,
+    SEARCH_CACHE_TTL,
+    SEARCH_CACHE_NEGATIVE_TTL,
+)
+link_cache = QueryCache(
+    partial(load_cached, "VideoLinks"),
+    partial(store_cached, "VideoLinks"),
+    SEARCH_CACHE_SIZE,
+    YT_LINK_CACHE_TTL,
+    SEARCH_CACHE_NEGATIVE_TTL,
+)
+video_cache = QueryCache(
+    partial(load_cached, "VideoSearches"),
+    partial(store_cached, "VideoSearches"),
+    SEARCH_CACHE_SIZE,
+    YT_LINK_CACHE_TTL,
+    SEARCH_CACHE_NEGATIVE_TTL,
+)
+link_resolver = LinkResolver(
+    YT_TOKEN,
+    link_cache,
+    video_cache,
+    YT_DAILY_QUOTA,
+    YT_SEARCH_CONCURRENCY,
+    SEARCH_CANDIDATES,
+    VIDEO_MATCH_SCORE,
+    YT_API_URL,
+)
+covers = CoverCache("data/cache/covers", COVER_CACHE_SIZE, get_bytes_response)
+searches = SingleFlight()
+track_index = TrackIndex()
+link_checker = LinkChecker(
+    link_resolver,
+    track_index,
+    link_checks_busy,
+    LINK_CHECK_INTERVAL,
+    LINK_CHECK_BATCH,
+    LINK_CHECK_CONCURRENCY,
+    LINK_CHECK_AGE,
+    LINK_CHECK_RETRY,
+    LINK_CHECK_FAILURES,
+)
+outbound = OutboundScheduler(
+    TELEGRAM_RATE_LIMIT, TELEGRAM_CHAT_RATE_LIMIT, TELEGRAM_CHAT_BURST, TELEGRAM_RETRIES
+)
+
+# The scheduler wraps the metrics, so they time the requests themselves
+bot.session.middleware(outbound)
+bot.session.middleware(RequestMetrics())
+dp.message.middleware(HandlerMetrics(TRACE_LOG))
+dp.callback_query.middleware(HandlerMetrics(TRACE_LOG))
+dp.inline_query.middleware(HandlerMetrics(TRACE_LOG))
+Gauge(
+    "bot_cache_lookups",
+    "Lookups of in-memory and database caches since start",
+    ("cache", "result"),
+    lambda: {
+        ("keyboards", "hit"): keyboards.memory.hits,
+        ("keyboards", "miss"): keyboards.memory.misses,
+        ("search", "memory_hit"): metadata_cache.memory_hits,
+        ("search", "hit"): metadata_cache.hits,
+        ("search", "miss"): metadata_cache.misses,
+        ("youtube_links", "memory_hit"): link_cache.memory_hits,
+        ("youtube_links", "hit"): link_cache.hits,
+        ("youtube_links", "miss"): link_cache.misses,
+        ("youtube_searches", "memory_hit"): video_cache.memory_hits,
+        ("youtube_searches", "hit"): video_cache.hits,
+        ("youtube_searches", "miss"): video_cache.misses,
+        ("searches_in_flight", "shared"): searches.shared,
+    },
+)
+Gauge(
+    "bot_youtube_searches",
+    "YouTube searches made through the Data API and, once its daily quota is "
+    "spent or it fails, through yt-dlp, since start",
+    ("source",),
+    lambda: {
+        ("api",): link_resolver.api_searches,
+        ("ytdlp",): link_resolver.fallback_searches,
+    },
+)
+Gauge(
+    "bot_downloads",
+    "Downloads waiting for and running on a worker, and prefetches among them",
+    ("state",),
+    lambda: {
+        ("queued",): downloader.queue_depth,
+        ("active",): downloader.active,
+        ("prefetching",): downloader.prefetching,
+    },
+)
+Gauge(
+    "bot_telegram_queue",
+    "Messages and edits waiting for the rate limits",
+    ("priority",),
+    lambda: {(priority,): outbound.queue_depth(priority) for priority in PRIORITIES},
+)
+
+
+async def on_startup():
+    await db.start()
+    await db.write(init_db)
+    await purge_cache("SearchCache")
+    await purge_cache("VideoLinks")
+    await purge_cache("VideoSearches")
+    await sync_track_index()
+    await http.start()
+    await covers.start()
+    await audio_cache.start()
+    await downloader.start()
+    await outbound.start()
+    await link_checker.start()
+
+
+async def on_shutdown():
+    await link_checker.stop()
+    await downloader.stop()
+    await outbound.stop()
+    await http.close()
+    await db.stop()
+
+
+dp.startup.register(on_startup)
+dp.shutdown.register(on_shutdown)
 
 
-@dp.message(CommandStart())
+@router.message(CommandStart())
 async def command_start_handler(message: Message):
-    cur.execute("INSERT OR IGNORE INTO Users(id, playlists) VALUES (?, ?)", [message.from_user.id, ""])  # type: ignore
-    con.commit()
+    await add_user(message.from_user.id)  # type: ignore
     keyboard = ReplyKeyboardBuilder()
     keyboard.button(text="My library")
     keyboard.button(text="Track search")
@@ -0,0 +1,143 @@
+import asyncio
+import json
+import time
+from collections import OrderedDict, defaultdict
+
+
+class LRUCache:
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.items = OrderedDict()
+        self.groups = defaultdict(set)
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def get(self, key, default=None):
+        if key not in self.items:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self.items.move_to_end(key)
+        return self.items[key][0]
+
+    def put(self, key, value, group=None):
+        if self.maxsize <= 0:
+            return
+        self.pop(key)
+        self.items[key] = (value, group)
+        if group is not None:
+            self.groups[group].add(key)
+        while len(self.items) > self.maxsize:
+            self.pop(next(iter(self.items)))
+
+    def pop(self, key):
+        if key not in self.items:
+            return
+        _, group = self.items.pop(key)
+        if group is not None:
+            self.groups[group].discard(key)
+            if not self.groups[group]:
+                del self.groups[group]
+
+    def invalidate(self, group):
+        for key in self.groups.pop(group, ()):
+            self.items.pop(key, None)
+
+
+class SharedLRUCache:
+    # LRU cache whose groups can be invalidated by other processes sharing
+    # the database. Every group has a revision counter there, entries
+    # remember the revision they were built at and are stale once it moves.
+    # Callers read the revision before building an entry and store it with
+    # the entry, so a concurrent invalidation is never lost.
+    def __init__(self, maxsize, load_revision, bump_revision):
+        self.memory = LRUCache(maxsize)
+        self.load_revision = load_revision
+        self.bump_revision = bump_revision
+
+    async def revision(self, group):
+        return await self.load_revision(" ".join(map(str, group)))
+
+    def get(self, key, revision):
+        entry = self.memory.get(key)
+        if entry is None or entry[0] != revision:
+            return None
+        return entry[1]
+
+    def put(self, key, value, group, revision):
+        self.memory.put(key, (revision, value), group)
+
+    async def invalidate(self, group):
+        self.memory.invalidate(group)
+        await self.bump_revision(" ".join(map(str, group)))
+
+
+MISSING = object()
+
+
+def normalize_query(text):
+    return " ".join(text.casefold().split())
+
+
+class QueryCache:
+    # Two tier cache for results of remote lookups: recent entries are kept
+    # in memory, everything else is loaded from and stored to the database
+    # through the load/store coroutines. Empty results (None) are cached for
+    # negative_ttl seconds only.
+    def __init__(self, load, store, maxsize, ttl, negative_ttl):
+        self.load = load
+        self.store = store
+        self.memory = LRUCache(maxsize)
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.hits = 0
+        self.memory_hits = 0
+        self.misses = 0
+
+    async def get(self, key):
+        now = time.time()
+        entry = self.memory.get(key)
+        if entry is not None and entry[0] >= now:
+            self.memory_hits += 1
+        else:
+            entry = await self.load(key)
+            if entry is None or entry[0] < now:
+                self.misses += 1
+                return MISSING
+            self.memory.put(key, entry)
+        self.hits += 1
+        return json.loads(entry[1])
+
+    async def put(self, key, value):
+        ttl = self.ttl if value is not None else self.negative_ttl
+        entry = (time.time() + ttl, json.dumps(value))
+        self.memory.put(key, entry)
+        await self.store(key, *entry)
+
+
+class SingleFlight:
+    # Concurrent calls with the same key share one in-flight call instead of
+    # each running its own. The call is shielded, so a cancelled caller
+    # doesn't cancel it for the others.
+    def __init__(self):
+        self.calls = {}
+        self.shared = 0
+
+    async def run(self, key, fn, *args):
+        task = self.calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(fn(*args))
+            self.calls[key] = task
+            task.add_done_callback(lambda task: self.done(key, task))
+        else:
+            self.shared += 1
+        return await asyncio.shield(task)
+
+    def done(self, key, task):
+        if self.calls.get(key) is task:
+            del self.calls[key]
+        if not task.cancelled():
+            task.exception()
@@ -0,0 +1,76 @@
+import asyncio
+import os
+from contextlib import suppress
+
+from aiogram.types import BufferedInputFile, URLInputFile
+
+
+class CoverCache:
+    # Telegram file_ids are stored per track by the caller, this only keeps
+    # the cover bytes on disk for covers that haven't been uploaded yet.
+    # Files are evicted least recently used first once max_bytes is exceeded,
+    # a max_bytes of 0 disables the disk cache.
+    def __init__(self, directory, max_bytes, fetch):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.fetch = fetch
+        self.size = 0
+
+    async def start(self):
+        if self.max_bytes > 0:
+            os.makedirs(self.directory, exist_ok=True)
+            self.size = await asyncio.to_thread(self.evict)
+
+    def path(self, track_id):
+        return os.path.join(self.directory, f"{track_id}.jpg")
+
+    def read(self, track_id):
+        try:
+            with open(self.path(track_id), "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        with suppress(FileNotFoundError):
+            os.utime(self.path(track_id))
+        return data
+
+    def write(self, track_id, data):
+        tmp = f"{self.path(track_id)}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        # A cover written meanwhile by another process is replaced
+        with suppress(FileNotFoundError):
+            self.size -= os.path.getsize(self.path(track_id))
+        os.replace(tmp, self.path(track_id))
+        self.size += len(data)
+        if self.size > self.max_bytes:
+            self.size = self.evict()
+
+    def evict(self):
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file():
+                stat = entry.stat()
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+        files.sort()
+        size = sum(file_size for _, file_size, _ in files)
+        for _, file_size, path in files:
+            if size <= self.max_bytes:
+                break
+            with suppress(FileNotFoundError):
+                os.remove(path)
+            size -= file_size
+        return size
+
+    async def get(self, track_id, cover_link, file_id=None):
+        if file_id is not None:
+            return file_id
+        if self.max_bytes > 0:
+            data = await asyncio.to_thread(self.read, track_id)
+            if data is None:
+                data = await self.fetch(cover_link)
+                if data is not None:
+                    await asyncio.to_thread(self.write, track_id, data)
+            if data is not None:
+                return BufferedInputFile(data, filename="cover.png")
+        return URLInputFile(cover_link, filename="cover.png")
@@ -0,0 +1,125 @@
+import asyncio
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from .metrics import DB_BATCH_SIZE, DB_COMMIT_SECONDS, DB_SECONDS
+
+
+class Database:
+    def __init__(self, path, readers=4, batch_size=64):
+        self.path = path
+        self.readers = readers
+        self.batch_size = batch_size
+        self.local = threading.local()
+        self.connections = []
+        self.read_pool = None
+        self.write_pool = None
+        self.writes = None
+        self.writer_task = None
+
+    def connect(self):
+        # Autocommit mode, transactions are opened explicitly by the writer.
+        # The statement cache keeps the prepared statements of every query
+        # the handlers run, so they're compiled once per connection.
+        con = sqlite3.connect(
+            self.path,
+            timeout=30,
+            isolation_level=None,
+            check_same_thread=False,
+            cached_statements=256,
+        )
+        con.execute("PRAGMA journal_mode = WAL")
+        con.execute("PRAGMA synchronous = NORMAL")
+        return con
+
+    def connection(self):
+        con = getattr(self.local, "con", None)
+        if con is None:
+            con = self.local.con = self.connect()
+            self.connections.append(con)
+        return con
+
+    async def start(self):
+        self.read_pool = ThreadPoolExecutor(self.readers, thread_name_prefix="db-read")
+        self.write_pool = ThreadPoolExecutor(1, thread_name_prefix="db-write")
+        self.writes = asyncio.Queue()
+        self.writer_task = asyncio.create_task(self.writer())
+
+    async def stop(self):
+        await self.writes.join()
+        self.writer_task.cancel()
+        await asyncio.gather(self.writer_task, return_exceptions=True)
+        self.read_pool.shutdown()
+        self.write_pool.shutdown()
+        for con in self.connections:
+            con.close()
+        self.connections = []
+
+    def run(self, fn):
+        return fn(self.connection())
+
+    async def read(self, fn):
+        loop = asyncio.get_running_loop()
+        with DB_SECONDS.time(kind="read"):
+            return await loop.run_in_executor(self.read_pool, self.run, fn)
+
+    async def fetchone(self, sql, params=()):
+        return await self.read(lambda con: con.execute(sql, params).fetchone())
+
+    async def fetchall(self, sql, params=()):
+        return await self.read(lambda con: con.execute(sql, params).fetchall())
+
+    async def write(self, fn):
+        future = asyncio.get_running_loop().create_future()
+        self.writes.put_nowait((fn, future))
+        with DB_SECONDS.time(kind="write"):
+            return await future
+
+    async def execute(self, sql, params=()):
+        return await self.write(lambda con: con.execute(sql, params).lastrowid)
+
+    def commit(self, batch):
+        con = self.connection()
+        results = []
+        try:
+            con.execute("BEGIN IMMEDIATE")
+            for fn, _ in batch:
+                # Every write gets its own savepoint, so one failing handler
+                # doesn't roll back the others sharing the transaction
+                con.execute("SAVEPOINT write")
+                try:
+                    result = fn(con)
+                except Exception as e:
+                    con.execute("ROLLBACK TO write")
+                    results.append((None, e))
+                else:
+                    results.append((result, None))
+                con.execute("RELEASE write")
+            con.execute("COMMIT")
+        except Exception as e:
+            if con.in_transaction:
+                con.execute("ROLLBACK")
+            return [(None, e) for _ in batch]
+        return results
+
+    async def writer(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            # Writes queued while the previous batch was committing are
+            # grouped into a single transaction and a single fsync
+            batch = [await self.writes.get()]
+            while len(batch) < self.batch_size and not self.writes.empty():
+                batch.append(self.writes.get_nowait())
+            start = time.perf_counter()
+            results = await loop.run_in_executor(self.write_pool, self.commit, batch)
+            DB_COMMIT_SECONDS.observe(time.perf_counter() - start)
+            DB_BATCH_SIZE.observe(len(batch))
+            for (_, future), (result, error) in zip(batch, results):
+                if not future.done():
+                    if error is None:
+                        future.set_result(result)
+                    else:
+                        future.set_exception(error)
+                self.writes.task_done()
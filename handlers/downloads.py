@@ -0,0 +1,325 @@
+import asyncio
+import functools
+import itertools
+import logging
+import multiprocessing
+import os
+import resource
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import asynccontextmanager
+
+from .metrics import (
+    DOWNLOAD_CPU_SECONDS,
+    DOWNLOAD_SECONDS,
+    DOWNLOADS,
+    PREFETCH_WASTED_CPU_SECONDS,
+    PREFETCHES,
+)
+
+# Requested downloads are queued before prefetches
+REQUESTED, PREFETCH = 0, 1
+# Audio formats a stream's codec can be copied into without re-encoding
+REMUX_FORMATS = {"mp4a": "m4a", "aac": "m4a", "mp3": "mp3", "opus": "opus"}
+
+
+class DownloadError(Exception):
+    pass
+
+
+def pool_errors(error):
+    # Exceptions raised in a pool process are pickled back to the bot, and
+    # yt-dlp's don't always survive it. Functions run in a pool are wrapped
+    # to raise any exception as error with the same message instead.
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            try:
+                return fn(*args, **kwargs)
+            except Exception as e:
+                raise error(str(e)) from None
+
+        return wrapper
+
+    return decorator
+
+
+def audio_postprocessors(info, formats, codec, quality):
+    # Streams in a format Telegram plays are kept as they are, streams whose
+    # codec fits one of those formats are only remuxed, anything else is
+    # transcoded to the fallback codec
+    if info["ext"] in formats:
+        return "passthrough", []
+    container = REMUX_FORMATS.get((info.get("acodec") or "").split(".")[0])
+    if container in formats:
+        return "remux", [{"key": "FFmpegExtractAudio", "preferredcodec": container}]
+    return "transcode", [
+        {
+            "key": "FFmpegExtractAudio",
+            "preferredcodec": codec,
+            "preferredquality": quality,
+        }
+    ]
+
+
+@pool_errors(DownloadError)
+def download_audio(yt_link, outtmpl, formats, codec, quality):
+    # Runs in a pool process, returns the downloaded file, how it was
+    # produced, the CPU time spent on it including ffmpeg and the part of
+    # the run spent converting it. yt-dlp is imported by the pool processes
+    # only.
+    import yt_dlp
+
+    cpu_time = time.process_time()
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    convert_time = 0
+
+    def convert_hook(d):
+        nonlocal convert_time
+        if d["postprocessor"] != "ExtractAudio":
+            return
+        if d["status"] == "started":
+            convert_time -= time.perf_counter()
+        elif d["status"] == "finished":
+            convert_time += time.perf_counter()
+
+    yt_dlp_opts = {
+        "format": "/".join(f"bestaudio[ext={fmt}]" for fmt in formats)
+        + "/bestaudio/best",
+        "socket_timeout": 10,
+        "outtmpl": f"{outtmpl}.%(ext)s",
+        "quiet": True,
+        "noprogress": True,
+        "postprocessor_hooks": [convert_hook],
+    }
+    with yt_dlp.YoutubeDL(yt_dlp_opts) as ydl:
+        info = ydl.extract_info(yt_link, download=False)
+    mode, yt_dlp_opts["postprocessors"] = audio_postprocessors(
+        info, formats, codec, quality
+    )
+    with yt_dlp.YoutubeDL(yt_dlp_opts) as ydl:
+        info = ydl.process_ie_result(info, download=True)
+    path = info["requested_downloads"][0]["filepath"]  # type: ignore
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpu_time = time.process_time() - cpu_time
+    cpu_time += usage.ru_utime - children.ru_utime + usage.ru_stime - children.ru_stime
+    return path, mode, cpu_time, convert_time
+
+
+class Job:
+    def __init__(self, track_id, yt_link, outtmpl, prefetch=False):
+        self.track_id = track_id
+        self.yt_link = yt_link
+        self.outtmpl = outtmpl
+        # Until someone asks for the track
+        self.prefetch = prefetch
+        self.path = None
+        self.mode = None
+        self.cpu_time = None
+        self.convert_time = None
+        self.future = asyncio.get_running_loop().create_future()
+        self.waiters = 0
+        self.queued_at = time.monotonic()
+        self.started_at = None
+        self.finished_at = None
+
+
+class Downloader:
+    # Downloads tracks into the audio cache on a process pool, one job per
+    # track however many users wait for it. Tracks can also be prefetched
+    # when they are likely to be requested soon: prefetches are queued
+    # behind every requested download, at most prefetch_limit of them run
+    # or wait at once and never on every worker, and they stop while
+    # prefetched files nobody asked for yet take more than prefetch_budget
+    # bytes. Those not asked for within prefetch_ttl seconds are counted as
+    # wasted.
+    def __init__(
+        self,
+        cache,
+        workers,
+        formats,
+        codec,
+        quality,
+        prefetch_limit=0,
+        prefetch_budget=1 << 28,
+        prefetch_ttl=600,
+    ):
+        self.cache = cache
+        self.workers = workers
+        self.formats = formats
+        self.codec = codec
+        self.quality = quality
+        # A worker is always left for requested downloads
+        self.prefetch_limit = min(prefetch_limit, workers - 1)
+        self.prefetch_budget = prefetch_budget
+        self.prefetch_ttl = prefetch_ttl
+        # Runs in the pool, replaced by a stub in benchmarks
+        self.download = download_audio
+        self.pool = None
+        self.queue = None
+        self.tasks = []
+        self.jobs = {}
+        self.active = 0
+        self.order = itertools.count()
+        # track_id -> (finished_at, size, cpu_time) of prefetched files
+        # nobody asked for yet
+        self.prefetched = {}
+
+    async def start(self):
+        # The bot already runs threads by now, which forking doesn't copy
+        # safely. Workers are forked from a clean server process instead.
+        self.pool = ProcessPoolExecutor(
+            self.workers, mp_context=multiprocessing.get_context("forkserver")
+        )
+        self.queue = asyncio.PriorityQueue()
+        self.tasks = [asyncio.create_task(self.worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+        if self.pool is not None:
+            self.pool.shutdown(cancel_futures=True)
+            self.pool = None
+
+    @property
+    def queue_depth(self):
+        return self.queue.qsize() if self.queue is not None else 0
+
+    @property
+    def prefetching(self):
+        return sum(job.prefetch for job in self.jobs.values())
+
+    def enqueue(self, job, priority):
+        self.queue.put_nowait((priority, next(self.order), job))  # type: ignore
+
+    async def worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            _, _, job = await self.queue.get()
+            if job.started_at is not None:
+                # A prefetch queued again when it was requested
+                self.queue.task_done()
+                continue
+            job.started_at = time.monotonic()
+            self.active += 1
+            try:
+                result = await loop.run_in_executor(
+                    self.pool,
+                    self.download,
+                    job.yt_link,
+                    job.outtmpl,
+                    self.formats,
+                    self.codec,
+                    self.quality,
+                )
+                path, job.mode, job.cpu_time, job.convert_time = result
+                fmt = os.path.splitext(path)[1][1:]
+                job.path = await self.cache.put(job.track_id, fmt, path)
+                if job.prefetch:
+                    self.prefetched[job.track_id] = (
+                        time.monotonic(),
+                        os.path.getsize(job.path),
+                        job.cpu_time,
+                    )
+            except Exception as e:
+                job.future.set_exception(
+                    e if isinstance(e, DownloadError) else DownloadError(str(e))
+                )
+            else:
+                job.future.set_result(job.path)
+            finally:
+                self.active -= 1
+                job.finished_at = time.monotonic()
+                wait = job.started_at - job.queued_at
+                run = job.finished_at - job.started_at
+                self.record(job, wait, run)
+                logging.info(
+                    "%s of track %s: waited %.2fs, took %.2fs (%s, %.2fs CPU)",
+                    "Prefetch" if job.prefetch else "Download",
+                    job.track_id,
+                    wait,
+                    run,
+                    job.mode,
+                    job.cpu_time or 0,
+                )
+                self.queue.task_done()
+                self.release(job)
+
+    def record(self, job, wait, run):
+        DOWNLOAD_SECONDS.observe(wait, stage="wait")
+        DOWNLOADS.inc(mode=job.mode or "none", result="ok" if job.path else "error")
+        if job.mode is not None:
+            DOWNLOAD_SECONDS.observe(run - job.convert_time, stage="download")
+            if job.convert_time:
+                DOWNLOAD_SECONDS.observe(job.convert_time, stage="convert")
+            DOWNLOAD_CPU_SECONDS.inc(job.cpu_time, mode=job.mode)
+
+    def release(self, job):
+        if job.waiters or not job.future.done():
+            return
+        if self.jobs.get(job.track_id) is job:
+            del self.jobs[job.track_id]
+            if job.path is not None:
+                self.cache.unpin(job.path)
+        job.future.exception()
+
+    def expire_prefetched(self):
+        expired = time.monotonic() - self.prefetch_ttl
+        for track_id, (finished_at, _, cpu_time) in list(self.prefetched.items()):
+            if finished_at < expired:
+                del self.prefetched[track_id]
+                PREFETCHES.inc(result="wasted")
+                PREFETCH_WASTED_CPU_SECONDS.inc(cpu_time or 0)
+
+    async def prefetch(self, track_id, yt_link):
+        # Starts downloading a track that will probably be requested soon,
+        # if the limits allow it
+        if not self.prefetch_limit or track_id in self.jobs:
+            return
+        self.expire_prefetched()
+        if track_id in self.prefetched or await self.cache.contains(track_id):
+            return
+        unused = sum(size for _, size, _ in self.prefetched.values())
+        if self.prefetching >= self.prefetch_limit or unused >= self.prefetch_budget:
+            PREFETCHES.inc(result="skipped")
+            return
+        if track_id in self.jobs:
+            return
+        job = Job(track_id, yt_link, self.cache.tmp_template(), prefetch=True)
+        self.jobs[track_id] = job
+        self.enqueue(job, PREFETCH)
+        PREFETCHES.inc(result="started")
+
+    @asynccontextmanager
+    async def fetch(self, track_id, yt_link):
+        # Yields the path of the track in the audio cache, downloading it
+        # first if needed. The file can't be evicted until the block exits.
+        path = await self.cache.get(track_id)
+        if path is not None and self.prefetched.pop(track_id, None) is not None:
+            PREFETCHES.inc(result="hit")
+        if path is None:
+            job = self.jobs.get(track_id)
+            if job is None:
+                job = Job(track_id, yt_link, self.cache.tmp_template())
+                self.jobs[track_id] = job
+                self.enqueue(job, REQUESTED)
+            elif job.prefetch:
+                # Still downloading, or still waiting behind other downloads
+                # in which case it moves ahead of the other prefetches
+                job.prefetch = False
+                PREFETCHES.inc(result="hit")
+                if job.started_at is None:
+                    self.enqueue(job, REQUESTED)
+            job.waiters += 1
+            try:
+                path = await asyncio.shield(job.future)
+                self.cache.pin(path)
+            finally:
+                job.waiters -= 1
+                self.release(job)
+        try:
+            yield path
+        finally:
+            self.cache.unpin(path)
@@ -0,0 +1,51 @@
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder
+from aiogram.fsm.storage.memory import MemoryStorage
+
+from .repository import (
+    get_fsm_data,
+    get_fsm_state,
+    set_fsm_data,
+    set_fsm_state,
+    update_fsm_data,
+)
+
+
+class SQLiteStorage(BaseStorage):
+    # Dialogue states are kept in the bot's database, so they survive
+    # restarts and are shared by every process using the same database
+    def __init__(self):
+        self.key_builder = DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+
+    async def set_state(self, key, state=None):
+        state = state.state if isinstance(state, State) else state
+        await set_fsm_state(self.key_builder.build(key), state)
+
+    async def get_state(self, key):
+        return await get_fsm_state(self.key_builder.build(key))
+
+    async def set_data(self, key, data):
+        await set_fsm_data(self.key_builder.build(key), dict(data))
+
+    async def get_data(self, key):
+        return await get_fsm_data(self.key_builder.build(key))
+
+    async def update_data(self, key, data):
+        return await update_fsm_data(self.key_builder.build(key), dict(data))
+
+    async def close(self):
+        pass
+
+
+def create_storage(url):
+    # "sqlite", "memory" or the url of a redis server, the redis client is
+    # only needed (and imported) when one is configured
+    if url == "sqlite":
+        return SQLiteStorage()
+    if url == "memory":
+        return MemoryStorage()
+    from aiogram.fsm.storage.redis import RedisStorage
+
+    return RedisStorage.from_url(
+        url, key_builder=DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+    )
@@ -0,0 +1,68 @@
+import asyncio
+import logging
+from urllib.parse import urlsplit
+
+import aiohttp
+
+from .metrics import EXTERNAL_SECONDS
+
+
+class HttpClient:
+    def __init__(
+        self,
+        limit=100,
+        limit_per_host=10,
+        timeout=10,
+        retries=2,
+        backoff=0.5,
+        dns_cache_ttl=300,
+        keepalive_timeout=60,
+    ):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.retries = retries
+        self.backoff = backoff
+        self.dns_cache_ttl = dns_cache_ttl
+        self.keepalive_timeout = keepalive_timeout
+        self.session = None
+
+    async def start(self):
+        connector = aiohttp.TCPConnector(
+            limit=self.limit,
+            limit_per_host=self.limit_per_host,
+            ttl_dns_cache=self.dns_cache_ttl,
+            keepalive_timeout=self.keepalive_timeout,
+        )
+        self.session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def get(self, url, params=None, kind="text"):
+        with EXTERNAL_SECONDS.time(service=urlsplit(url).hostname, operation="get"):
+            return await self.request(url, params, kind)
+
+    async def request(self, url, params, kind):
+        # Server errors and connection failures are retried with exponential
+        # backoff, any other unsuccessful response is returned as None
+        for attempt in range(self.retries + 1):
+            if attempt:
+                await asyncio.sleep(self.backoff * 2 ** (attempt - 1))
+            try:
+                async with self.session.get(url, params=params) as resp:  # type: ignore
+                    if resp.status >= 500:
+                        logging.warning("GET %s returned %s", url, resp.status)
+                        continue
+                    if not resp.ok:
+                        return None
+                    if kind == "json":
+                        return await resp.json(content_type=None)
+                    if kind == "bytes":
+                        return await resp.read()
+                    return await resp.text()
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                logging.warning("GET %s failed: %r", url, e)
+        return None
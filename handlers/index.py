@@ -0,0 +1,117 @@
+import heapq
+import re
+from bisect import bisect_left, insort
+
+from rapidfuzz import fuzz
+
+from .cache import normalize_query
+
+WORD = re.compile(r"\w+")
+
+
+class TrackIndex:
+    # In-memory index of the stored tracks for inline queries. The words of
+    # titles and artists are kept sorted, so the tracks with a word starting
+    # with a query word are found by bisection. Query words no word starts
+    # with are matched to words sharing a trigram with them that are close
+    # enough, to forgive typos. A track has to match every query word.
+    def __init__(self, fuzzy_score=75):
+        self.fuzzy_score = fuzzy_score
+        # id -> (title, artists, cover_link, yt_link, file_id)
+        self.tracks = {}
+        self.words = []
+        self.postings = {}
+        self.trigrams = {}
+        self.last_id = 0
+        self.synced_at = 0
+
+    def __len__(self):
+        return len(self.tracks)
+
+    def add(self, track_id, title, artists, cover_link, yt_link, file_id=None):
+        self.last_id = max(self.last_id, track_id)
+        if track_id in self.tracks:
+            return
+        self.tracks[track_id] = (title, artists, cover_link, yt_link, file_id)
+        for word in set(WORD.findall(f"{artists} {title}".casefold())):
+            postings = self.postings.get(word)
+            if postings is None:
+                postings = self.postings[word] = set()
+                insort(self.words, word)
+                for i in range(len(word) - 2):
+                    self.trigrams.setdefault(word[i : i + 3], set()).add(word)
+            postings.add(track_id)
+
+    def set_file_id(self, track_id, file_id):
+        track = self.tracks.get(track_id)
+        if track is not None:
+            self.tracks[track_id] = (*track[:4], file_id)
+
+    def set_yt_link(self, track_id, yt_link):
+        track = self.tracks.get(track_id)
+        if track is not None:
+            self.tracks[track_id] = (*track[:3], yt_link, track[4])
+
+    def matches(self, term):
+        # Tracks matching a query word with how well they match it: 2 for
+        # the whole word, 1 for a prefix, less for a similar word
+        scores = {}
+        i = bisect_left(self.words, term)
+        while i < len(self.words) and self.words[i].startswith(term):
+            word = self.words[i]
+            score = 2 if word == term else 1
+            for track_id in self.postings[word]:
+                scores[track_id] = max(scores.get(track_id, 0), score)
+            i += 1
+        if scores:
+            return scores
+        similar = set()
+        for j in range(len(term) - 2):
+            similar |= self.trigrams.get(term[j : j + 3], set())
+        for word in similar:
+            ratio = fuzz.ratio(term, word)
+            if ratio < self.fuzzy_score:
+                continue
+            for track_id in self.postings[word]:
+                scores[track_id] = max(scores.get(track_id, 0), ratio / 100)
+        return scores
+
+    def search(self, query, offset=0, limit=20):
+        # Returns a page of (id, title, artists, cover_link, yt_link, file_id)
+        # and whether there are more. Without a query the latest tracks are
+        # listed, otherwise the best matches come first, downloaded tracks
+        # and newer ones before the rest.
+        terms = WORD.findall(normalize_query(query))
+        if not terms:
+            ranked = sorted(self.tracks, reverse=True)
+            return self.page(ranked, offset, limit), len(self.tracks) > offset + limit
+        scores = None
+        for term in terms:
+            matches = self.matches(term)
+            if scores is None:
+                scores = matches
+            else:
+                scores = {
+                    track_id: score + matches[track_id]
+                    for track_id, score in scores.items()
+                    if track_id in matches
+                }
+            if not scores:
+                return [], False
+        # Only the tracks up to the requested page are ranked
+        ranked = heapq.nsmallest(
+            offset + limit,
+            scores,  # type: ignore
+            key=lambda track_id: (
+                -scores[track_id],  # type: ignore
+                self.tracks[track_id][4] is None,
+                -track_id,
+            ),
+        )
+        return self.page(ranked, offset, limit), len(scores) > offset + limit  # type: ignore
+
+    def page(self, ranked, offset, limit):
+        return [
+            (track_id, *self.tracks[track_id])
+            for track_id in ranked[offset : offset + limit]
+        ]
@@ -0,0 +1,135 @@
+import asyncio
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from .metrics import EXTERNAL_SECONDS, LINK_CHECKS
+from .repository import (
+    claim_links,
+    flag_track_link,
+    replace_track_link,
+    set_link_failures,
+)
+from .youtube import check_video
+
+
+class LinkChecker:
+    # Checks the stored youtube links in the background, so videos that
+    # were removed or blocked are found before someone tries to download
+    # them. Every interval seconds a batch of links due for a check is
+    # claimed and checked, concurrency at a time, by fetching the videos'
+    # metadata only in a process pool of their own, so checks never take a
+    # download worker. Links are checked again after recheck_after seconds,
+    # failing ones sooner. A link failing max_failures checks in a row is
+    # replaced by the track's best other video. Checks wait while busy()
+    # says downloads or searches are running. When a check can't tell, e.g.
+    # YouTube asks this host to prove it's not a bot, the rest of the batch
+    # is left for later and the pause before the next one doubles, up to an
+    # hour.
+    def __init__(
+        self,
+        resolver,
+        index,
+        busy,
+        interval=60,
+        batch_size=20,
+        concurrency=2,
+        recheck_after=604800,
+        retry_after=3600,
+        max_failures=2,
+    ):
+        self.resolver = resolver
+        self.index = index
+        self.busy = busy
+        self.interval = interval
+        self.batch_size = batch_size
+        self.recheck_after = recheck_after
+        self.retry_after = retry_after
+        self.max_failures = max_failures
+        # Runs in the pool, replaced by a stub in benchmarks
+        self.check_video = check_video
+        self.concurrency = concurrency
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.pool = None
+        self.task = None
+        self.backoff = 0
+        self.halted = False
+
+    async def start(self):
+        if self.interval:
+            # Forked from a clean server process like the download workers
+            self.pool = ProcessPoolExecutor(
+                self.concurrency, mp_context=multiprocessing.get_context("forkserver")
+            )
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+        if self.pool is not None:
+            self.pool.shutdown(cancel_futures=True)
+            self.pool = None
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval + self.backoff)
+            self.halted = False
+            try:
+                tracks = await claim_links(
+                    self.batch_size, self.recheck_after, self.retry_after
+                )
+                await asyncio.gather(*(self.check(*track) for track in tracks))
+            except Exception:
+                logging.exception("Link check failed")
+
+    async def idle(self):
+        while self.busy():
+            await asyncio.sleep(1)
+
+    async def check(self, track_id, title, artists, yt_link, failures):
+        async with self.semaphore:
+            await self.idle()
+            if self.halted:
+                await flag_track_link(track_id)
+                return
+            loop = asyncio.get_running_loop()
+            try:
+                with EXTERNAL_SECONDS.time(service="youtube", operation="ytdlp_check"):
+                    alive = await loop.run_in_executor(
+                        self.pool, self.check_video, yt_link
+                    )
+            except Exception as e:
+                # Not counted against the video, it's checked again with the
+                # links due after recheck_after. The links the rest of the
+                # batch skips are checked first thing once the pause is over.
+                logging.warning("Checking %s failed: %s", yt_link, e)
+                LINK_CHECKS.inc(result="error")
+                self.halted = True
+                self.backoff = min(max(2 * self.backoff, self.interval), 3600)
+                return
+            self.backoff = 0
+            if alive:
+                LINK_CHECKS.inc(result="alive")
+                if failures:
+                    await set_link_failures(track_id, 0)
+                return
+            LINK_CHECKS.inc(result="dead")
+            failures += 1
+            if failures >= self.max_failures:
+                await self.idle()
+                new_link = await self.resolver.resolve(title, artists, dead=yt_link)
+                if new_link is not None:
+                    logging.info(
+                        "Link of track %s is dead, replaced %s with %s",
+                        track_id,
+                        yt_link,
+                        new_link,
+                    )
+                    await replace_track_link(track_id, new_link)
+                    self.index.set_yt_link(track_id, new_link)
+                    LINK_CHECKS.inc(result="replaced")
+                    return
+                logging.warning("Link of track %s is dead, no other video found", track_id)
+            await set_link_failures(track_id, failures)
@@ -0,0 +1,75 @@
+import hashlib
+import math
+import random
+from functools import lru_cache
+from io import BytesIO
+
+SIZE = 300
+PALETTE = [
+    "#0a0310",
+    "#49007e",
+    "#ff005b",
+    "#ff7d10",
+    "#ffb238",
+    "#1b998b",
+    "#2e86ab",
+    "#f6f5ae",
+    "#e84855",
+    "#3d5a80",
+]
+
+
+def rotate(points, angle, center):
+    cos, sin = math.cos(angle), math.sin(angle)
+    cx, cy = center
+    return [
+        (cx + (x - cx) * cos - (y - cy) * sin, cy + (x - cx) * sin + (y - cy) * cos)
+        for x, y in points
+    ]
+
+
+@lru_cache(maxsize=128)
+def render_logo(name):
+    # Bauhaus-like composition of a rectangle, a circle and a line, seeded
+    # by the playlist name so the same name always gets the same logo.
+    # Pillow is imported with the first logo.
+    from PIL import Image, ImageDraw
+
+    rnd = random.Random(hashlib.sha256(name.encode()).digest())
+    background, rect_color, circle_color, line_color = rnd.sample(PALETTE, 4)
+    logo = Image.new("RGB", (SIZE, SIZE), background)
+    draw = ImageDraw.Draw(logo)
+    center = (SIZE / 2 + rnd.uniform(-60, 60), SIZE / 2 + rnd.uniform(-60, 60))
+    width, height = rnd.uniform(120, 260), rnd.uniform(60, 200)
+    rect = [
+        (center[0] - width / 2, center[1] - height / 2),
+        (center[0] + width / 2, center[1] - height / 2),
+        (center[0] + width / 2, center[1] + height / 2),
+        (center[0] - width / 2, center[1] + height / 2),
+    ]
+    draw.polygon(rotate(rect, rnd.uniform(0, math.pi), center), fill=rect_color)
+    radius = rnd.uniform(40, 100)
+    x, y = rnd.uniform(radius, SIZE - radius), rnd.uniform(radius, SIZE - radius)
+    draw.ellipse((x - radius, y - radius, x + radius, y + radius), fill=circle_color)
+    center = (rnd.uniform(80, 220), rnd.uniform(80, 220))
+    line = [(center[0] - SIZE, center[1]), (center[0] + SIZE, center[1])]
+    draw.line(
+        rotate(line, rnd.uniform(0, math.pi), center),
+        fill=line_color,
+        width=rnd.randint(8, 24),
+    )
+    logo_bytes = BytesIO()
+    logo.save(logo_bytes, format="PNG")
+    return logo_bytes.getvalue()
+
+
+def convert_remote_logo(svg):
+    # cairosvg is only needed when logos come from the remote avatar service
+    from cairosvg import svg2png
+    from PIL import Image
+
+    logo = Image.open(BytesIO(svg2png(svg)))  # type: ignore
+    logo = logo.crop((10, 10, 310, 310))
+    logo_bytes = BytesIO()
+    logo.save(logo_bytes, format="PNG")
+    return logo_bytes.getvalue()
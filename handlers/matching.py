@@ -0,0 +1,64 @@
+from rapidfuzz import fuzz, process, utils
+
+# The scores are numpy arrays. numpy is slow to import, so it's imported by
+# the first call, and callers run these in a thread to keep that and the
+# scoring itself off the event loop.
+
+
+def text_scores(queries, choices, scorer):
+    import numpy as np
+
+    return process.cdist(
+        queries,
+        choices,
+        scorer=scorer,
+        processor=utils.default_process,
+        dtype=np.float32,
+    )
+
+
+def video_scores(tracks, videos):
+    # How well every video matches every track, from 0 to 100, scored in one
+    # pass over all the pairs. tracks are (title, artists, duration) and
+    # videos (video_id, title, duration), durations in seconds or None.
+    # Video titles often add things like "(Official Video)", so the whole
+    # name is compared as a set of words, and the title as a part of the
+    # video title counts for a little. Durations, when both are known, weigh
+    # in with 2 points lost per second of difference.
+    import numpy as np
+
+    if not tracks or not videos:
+        return np.zeros((len(tracks), len(videos)), dtype=np.float32)
+    video_titles = [title for _, title, _ in videos]
+    names = text_scores(
+        [f"{artists} {title}" for title, artists, _ in tracks],
+        video_titles,
+        fuzz.token_set_ratio,
+    )
+    titles = text_scores(
+        [title for title, _, _ in tracks], video_titles, fuzz.partial_ratio
+    )
+    text = 0.75 * names + 0.25 * titles
+    track_durations = np.array(
+        [duration or np.nan for _, _, duration in tracks], dtype=np.float32
+    )
+    video_durations = np.array(
+        [duration or np.nan for _, _, duration in videos], dtype=np.float32
+    )
+    difference = np.abs(track_durations[:, None] - video_durations[None, :])
+    durations = np.clip(100 - 2 * difference, 0, 100)
+    return np.where(np.isnan(difference), text, 0.85 * text + 0.15 * durations)
+
+
+def query_scores(query, tracks):
+    # How well every track matches what the user typed, as the title alone
+    # or with the artists in any order
+    import numpy as np
+
+    titles = text_scores([query], [title for title, _, _ in tracks], fuzz.ratio)
+    names = text_scores(
+        [query],
+        [f"{artists} {title}" for title, artists, _ in tracks],
+        fuzz.token_sort_ratio,
+    )
+    return np.maximum(titles, names)[0]
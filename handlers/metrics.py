@@ -0,0 +1,270 @@
+import contextvars
+import json
+import logging
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiohttp import web
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+REGISTRY = []
+# Timings recorded while handling the current update, only collected when
+# trace logs are enabled
+spans = contextvars.ContextVar("spans", default=None)
+
+
+def format_labels(names, values, extra=()):
+    pairs = [*zip(names, values), *extra]
+    if not pairs:
+        return ""
+    escape = (
+        lambda value: str(value)
+        .replace("\\", "\\\\")
+        .replace('"', '\\"')
+        .replace("\n", "\\n")
+    )
+    return "{" + ",".join(f'{name}="{escape(value)}"' for name, value in pairs) + "}"
+
+
+class Metric:
+    # Minimal counterpart of the prometheus_client metrics, rendered in the
+    # Prometheus text format by render()
+    type = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.series = {}
+        REGISTRY.append(self)
+
+    def key(self, labels):
+        return tuple(labels[name] for name in self.labels)
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} {self.type}"
+        yield from self.samples()
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        self.series[key] = self.series.get(key, 0) + amount
+
+    def samples(self):
+        for values, value in self.series.items():
+            yield f"{self.name}{format_labels(self.labels, values)} {value}"
+
+
+class Gauge(Metric):
+    # Values are read from fn at render time, fn returns a dict of label
+    # value tuples to values
+    type = "gauge"
+
+    def __init__(self, name, help, labels=(), fn=dict):
+        super().__init__(name, help, labels)
+        self.fn = fn
+
+    def samples(self):
+        for values, value in self.fn().items():
+            yield f"{self.name}{format_labels(self.labels, values)} {value}"
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = buckets
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        series = self.series.get(key)
+        if series is None:
+            # Observations per bucket (the last one is +Inf), sum and count
+            series = self.series[key] = [[0] * (len(self.buckets) + 1), 0, 0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.observe(elapsed, **labels)
+            trace = spans.get()
+            if trace is not None:
+                trace.append({"metric": self.name, **labels, "seconds": round(elapsed, 4)})
+
+    def samples(self):
+        for values, (counts, total, count) in self.series.items():
+            cumulative = 0
+            for bound, observations in zip((*self.buckets, "+Inf"), counts):
+                cumulative += observations
+                labels = format_labels(self.labels, values, [("le", bound)])
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            labels = format_labels(self.labels, values)
+            yield f"{self.name}_sum{labels} {total}"
+            yield f"{self.name}_count{labels} {count}"
+
+
+def render():
+    return "\n".join(line for metric in REGISTRY for line in metric.render()) + "\n"
+
+
+HANDLER_SECONDS = Histogram(
+    "bot_handler_seconds",
+    "Time spent handling an update",
+    ("handler", "action", "obj"),
+)
+HANDLER_ERRORS = Counter(
+    "bot_handler_errors_total",
+    "Updates whose handler raised",
+    ("handler", "action", "obj", "error"),
+)
+TELEGRAM_SECONDS = Histogram(
+    "bot_telegram_request_seconds",
+    "Duration of Bot API requests, including uploads",
+    ("method",),
+)
+TELEGRAM_ERRORS = Counter(
+    "bot_telegram_request_errors_total",
+    "Failed Bot API requests",
+    ("method", "error"),
+)
+TELEGRAM_QUEUE_SECONDS = Histogram(
+    "bot_telegram_queue_seconds",
+    "Time messages and edits waited for the rate limits before being sent",
+    ("priority",),
+)
+TELEGRAM_COALESCED = Counter(
+    "bot_telegram_coalesced_total",
+    "Edits replaced by a later edit of the same message before being sent",
+    ("method",),
+)
+EXTERNAL_SECONDS = Histogram(
+    "bot_external_request_seconds",
+    "Duration of requests to services other than Telegram",
+    ("service", "operation"),
+)
+DOWNLOAD_SECONDS = Histogram(
+    "bot_download_seconds",
+    "Time tracks spent waiting for a worker, downloading and converting",
+    ("stage",),
+)
+DOWNLOAD_CPU_SECONDS = Counter(
+    "bot_download_cpu_seconds_total",
+    "CPU time spent by download workers and ffmpeg",
+    ("mode",),
+)
+DOWNLOADS = Counter(
+    "bot_downloads_total",
+    "Finished downloads by how the audio was produced",
+    ("mode", "result"),
+)
+PREFETCHES = Counter(
+    "bot_prefetches_total",
+    "Prefetched downloads by outcome: started, skipped over the limits, hit "
+    "when the track was requested, wasted when it wasn't in time",
+    ("result",),
+)
+PREFETCH_WASTED_CPU_SECONDS = Counter(
+    "bot_prefetch_wasted_cpu_seconds_total",
+    "CPU time spent on prefetched tracks nobody requested in time",
+)
+LINK_CHECKS = Counter(
+    "bot_link_checks_total",
+    "Stored youtube links checked in the background by outcome: alive, dead, "
+    "error when the check itself failed, replaced when a dead one was found "
+    "again",
+    ("result",),
+)
+DB_SECONDS = Histogram(
+    "bot_db_seconds",
+    "Duration of database reads and writes as seen by handlers, queueing included",
+    ("kind",),
+)
+DB_COMMIT_SECONDS = Histogram(
+    "bot_db_commit_seconds",
+    "Duration of group commits of queued writes",
+)
+DB_BATCH_SIZE = Histogram(
+    "bot_db_batch_size",
+    "Number of writes committed together",
+    buckets=(1, 2, 4, 8, 16, 32, 64),
+)
+
+
+class HandlerMetrics(BaseMiddleware):
+    # Times every handler, labelled by the callback's action and obj (or
+    # the update type for messages and inline queries). With trace set, every update is also logged
+    # as one JSON line with the timings recorded while handling it.
+    def __init__(self, trace=False):
+        self.trace = trace
+
+    async def __call__(self, handler, event, data):
+        callback_data = data.get("callback_data")
+        labels = {
+            "handler": data["handler"].callback.__name__,
+            "action": getattr(
+                callback_data, "action", data["event_update"].event_type
+            ),
+            "obj": getattr(callback_data, "obj", ""),
+        }
+        token = spans.set([]) if self.trace else None
+        start = time.perf_counter()
+        error = None
+        try:
+            return await handler(event, data)
+        except Exception as e:
+            error = type(e).__name__
+            HANDLER_ERRORS.inc(error=error, **labels)
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            HANDLER_SECONDS.observe(elapsed, **labels)
+            if token is not None:
+                record = {
+                    "update": data["event_update"].update_id,
+                    "user": event.from_user.id if event.from_user else None,
+                    **labels,
+                    "seconds": round(elapsed, 4),
+                    "error": error,
+                    "spans": spans.get(),
+                }
+                logging.getLogger("trace").info(json.dumps(record))
+                spans.reset(token)
+
+
+class RequestMetrics(BaseRequestMiddleware):
+    async def __call__(self, make_request, bot, method):
+        name = method.__api_method__
+        try:
+            with TELEGRAM_SECONDS.time(method=name):
+                return await make_request(bot, method)
+        except Exception as e:
+            TELEGRAM_ERRORS.inc(method=name, error=type(e).__name__)
+            raise
+
+
+async def metrics_handler(request):
+    return web.Response(text=render(), content_type="text/plain", charset="utf-8")
+
+
+async def serve_metrics(host, port):
+    # Used when polling, in webhook mode /metrics is served by the webhook app
+    app = web.Application()
+    app.router.add_get("/metrics", metrics_handler)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
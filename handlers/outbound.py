@@ -0,0 +1,242 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from contextlib import suppress
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.types import InputFile
+
+from .metrics import TELEGRAM_COALESCED, TELEGRAM_QUEUE_SECONDS
+
+PRIORITIES = ("interactive", "upload")
+# Fields holding the file of the methods that can upload one
+UPLOAD_FIELDS = {
+    "sendAudio": "audio",
+    "sendDocument": "document",
+    "sendVideo": "video",
+    "sendVoice": "voice",
+}
+# A pending edit is replaced by a later edit of the same message that
+# changes at least as much of it
+EDIT_RANKS = {
+    "editMessageReplyMarkup": 0,
+    "editMessageCaption": 1,
+    "editMessageText": 1,
+    "editMessageMedia": 2,
+}
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.paused_until = 0
+
+    def delay(self, now):
+        # Seconds until a request may be sent
+        if now > self.updated:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+        return max(self.paused_until - now, (1 - self.tokens) / self.rate, 0)
+
+    def take(self):
+        self.tokens -= 1
+
+    def idle(self, now):
+        return self.delay(now) == 0 and self.tokens == self.burst
+
+
+class Request:
+    def __init__(self, bot, method, make_request, chat_id, priority):
+        self.bot = bot
+        self.method = method
+        self.make_request = make_request
+        self.chat_id = chat_id
+        self.priority = priority
+        self.edit_key = None
+        # The caller of the edit that is sent gets its result, the callers
+        # of the edits it replaced get True as if it had been sent for them
+        self.future = asyncio.get_running_loop().create_future()
+        self.futures = [self.future]
+        self.queued_at = time.monotonic()
+        self.attempts = 0
+
+    @property
+    def rank(self):
+        return EDIT_RANKS[self.method.__api_method__]
+
+
+class OutboundScheduler(BaseRequestMiddleware):
+    # Queues the messages and edits sent to chats and sends them within
+    # Telegram's overall rate limit, with a token bucket that allows short
+    # bursts. Uploads wait behind interactive requests and a pending edit is
+    # replaced by a later one of the same message. A flood error pauses its
+    # chat for as long as Telegram asks before the request is retried, and
+    # the chat is held to a per-chat rate until it has been quiet for a
+    # while, chats Telegram hasn't pushed back on aren't slowed down.
+    # Anything else, and everything before start(), is sent right away.
+    def __init__(self, rate=30, chat_rate=1, chat_burst=4, retries=3):
+        self.rate = rate
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.retries = retries
+        self.overall = TokenBucket(rate, rate)
+        self.chats = {}
+        self.queues = [deque() for _ in PRIORITIES]
+        self.edits = {}
+        self.sending = set()
+        self.wakeup = None
+        self.task = None
+        self.pruned_at = 0
+
+    async def start(self):
+        self.wakeup = asyncio.Event()
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        # Sends what is already queued first
+        futures = [future for queue in self.queues for r in queue for future in r.futures]
+        await asyncio.gather(*futures, *self.sending, return_exceptions=True)
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+
+    def queue_depth(self, priority):
+        return len(self.queues[PRIORITIES.index(priority)])
+
+    async def __call__(self, make_request, bot, method):
+        name = method.__api_method__
+        chat_id = getattr(method, "chat_id", None)
+        if self.task is None or chat_id is None or not name.startswith(("send", "edit")):
+            return await make_request(bot, method)
+        if name in EDIT_RANKS:
+            key = (chat_id, method.message_id)
+            pending = self.edits.get(key)
+            if pending is not None and EDIT_RANKS[name] >= pending.rank:
+                # Only the latest state of the message is sent. Its result
+                # isn't returned to the callers of the replaced edits, the
+                # photo it holds may not be the one they sent.
+                future = asyncio.get_running_loop().create_future()
+                pending.bot, pending.method = bot, method
+                pending.make_request = make_request
+                pending.future = future
+                pending.futures.append(future)
+                TELEGRAM_COALESCED.inc(method=name)
+                return await future
+        field = UPLOAD_FIELDS.get(name)
+        upload = field is not None and isinstance(getattr(method, field), InputFile)
+        request = Request(bot, method, make_request, chat_id, int(upload))
+        if name in EDIT_RANKS:
+            request.edit_key = key
+            self.edits[key] = request
+        self.queues[request.priority].append(request)
+        self.wakeup.set()  # type: ignore
+        return await request.futures[0]
+
+    def chat(self, chat_id):
+        bucket = self.chats.get(chat_id)
+        if bucket is None:
+            bucket = self.chats[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    def chat_delay(self, chat_id, now):
+        bucket = self.chats.get(chat_id)
+        return bucket.delay(now) if bucket is not None else 0
+
+    async def run(self):
+        while True:
+            now = time.monotonic()
+            delay = self.dispatch(now)
+            if delay is None and now - self.pruned_at > 60:
+                self.pruned_at = now
+                self.chats = {
+                    chat_id: bucket
+                    for chat_id, bucket in self.chats.items()
+                    if not bucket.idle(now)
+                }
+            self.wakeup.clear()  # type: ignore
+            with suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self.wakeup.wait(), delay)  # type: ignore
+
+    def dispatch(self, now):
+        # Sends every queued request the limits allow, interactive ones
+        # first. Returns how long until the next one can be sent, or None
+        # if nothing is queued.
+        delay = None
+        for queue in self.queues:
+            for request in list(queue):
+                wait = max(self.overall.delay(now), self.chat_delay(request.chat_id, now))
+                if wait > 0:
+                    delay = wait if delay is None else min(delay, wait)
+                    continue
+                queue.remove(request)
+                self.overall.take()
+                if request.chat_id in self.chats:
+                    self.chats[request.chat_id].take()
+                self.send(request, now)
+        return delay
+
+    def send(self, request, now):
+        if request.edit_key is not None and self.edits.get(request.edit_key) is request:
+            del self.edits[request.edit_key]
+        if all(future.done() for future in request.futures):
+            # Every caller was cancelled
+            return
+        TELEGRAM_QUEUE_SECONDS.observe(
+            now - request.queued_at, priority=PRIORITIES[request.priority]
+        )
+        task = asyncio.create_task(self.request(request))
+        self.sending.add(task)
+        task.add_done_callback(self.sending.discard)
+
+    async def request(self, request):
+        try:
+            response = await request.make_request(request.bot, request.method)
+        except TelegramRetryAfter as e:
+            request.attempts += 1
+            if request.attempts > self.retries:
+                self.resolve(request, exception=e)
+            else:
+                self.retry(request, e.retry_after)
+        except Exception as e:
+            self.resolve(request, exception=e)
+        else:
+            self.resolve(request, response)
+
+    def resolve(self, request, response=None, exception=None):
+        for future in request.futures:
+            if future.done():
+                continue
+            if exception is not None:
+                future.set_exception(exception)
+            elif future is request.future:
+                future.set_result(response)
+            else:
+                future.set_result(True)
+
+    def retry(self, request, retry_after):
+        # Nothing is sent to the chat until the pause is over, it gets longer
+        # with every attempt of the same request, and then the chat is paced
+        pause = retry_after * request.attempts
+        logging.warning(
+            "Flood control on chat %s, retrying %s in %ss",
+            request.chat_id,
+            request.method.__api_method__,
+            pause,
+        )
+        bucket = self.chat(request.chat_id)
+        bucket.paused_until = max(bucket.paused_until, time.monotonic() + pause)
+        if request.edit_key is not None:
+            pending = self.edits.get(request.edit_key)
+            if pending is not None and pending.rank >= request.rank:
+                pending.futures.extend(request.futures)
+                return
+            if pending is None:
+                self.edits[request.edit_key] = request
+        self.queues[request.priority].appendleft(request)
+        self.wakeup.set()  # type: ignore
@@ -0,0 +1,466 @@
+import json
+import time
+from math import ceil
+from os import getenv
+
+from .db import Database
+
+PAGE_SIZE = 5
+
+
+def migrate_memberships(con):
+    now = int(time.time())
+    sql = "INSERT OR IGNORE INTO UserPlaylists(user_id, playlist_id, position, added_at) VALUES (?, ?, ?, ?)"
+    for user_id, playlists in con.execute("SELECT id, playlists FROM Users").fetchall():
+        if playlists:
+            for position, playlist_id in enumerate(map(int, playlists.split(", "))):
+                con.execute(sql, [user_id, playlist_id, position, now])
+    sql = "INSERT OR IGNORE INTO PlaylistTracks(playlist_id, track_id, position, added_at) VALUES (?, ?, ?, ?)"
+    for playlist_id, tracks in con.execute("SELECT id, tracks FROM Playlists").fetchall():
+        if tracks:
+            for position, track_id in enumerate(map(int, tracks.split(", "))):
+                con.execute(sql, [playlist_id, track_id, position, now])
+
+
+def merge_duplicate_tracks(con):
+    # Tracks used to be inserted without a unique key, so concurrent searches
+    # could store the same track several times. The oldest row is kept and
+    # takes over the links, file_ids and playlist entries of the others.
+    # Cached audio of the duplicates is dropped from the index and its files
+    # are removed by the audio cache on startup.
+    sql = "SELECT artists, title, MIN(id) FROM Tracks GROUP BY artists, title HAVING COUNT(*) > 1"
+    for artists, title, keep in con.execute(sql).fetchall():
+        sql = "SELECT id FROM Tracks WHERE artists IS ? AND title IS ? AND id != ?"
+        duplicates = [row[0] for row in con.execute(sql, [artists, title, keep])]
+        for duplicate in duplicates:
+            sql = """UPDATE Tracks SET
+                     yt_link = COALESCE(yt_link, (SELECT yt_link FROM Tracks WHERE id = :duplicate)),
+                     file_id = COALESCE(file_id, (SELECT file_id FROM Tracks WHERE id = :duplicate)),
+                     cover_file_id = COALESCE(cover_file_id, (SELECT cover_file_id FROM Tracks WHERE id = :duplicate))
+                     WHERE id = :keep"""
+            con.execute(sql, {"keep": keep, "duplicate": duplicate})
+            sql = "UPDATE OR IGNORE PlaylistTracks SET track_id = ? WHERE track_id = ?"
+            con.execute(sql, [keep, duplicate])
+            con.execute("DELETE FROM PlaylistTracks WHERE track_id = ?", [duplicate])
+            con.execute("DELETE FROM AudioFiles WHERE track_id = ?", [duplicate])
+            con.execute("DELETE FROM Tracks WHERE id = ?", [duplicate])
+
+
+# Each entry upgrades the schema by one version, applied in order on startup.
+# Steps are either SQL statements or functions taking the connection.
+MIGRATIONS = [
+    ["ALTER TABLE Tracks ADD COLUMN file_id TEXT"],
+    [
+        "CREATE TABLE UserPlaylists (user_id INTEGER NOT NULL, playlist_id INTEGER NOT NULL, position INTEGER NOT NULL, added_at INTEGER NOT NULL, PRIMARY KEY (user_id, playlist_id))",
+        "CREATE INDEX UserPlaylistsPosition ON UserPlaylists(user_id, position)",
+        "CREATE TABLE PlaylistTracks (playlist_id INTEGER NOT NULL, track_id INTEGER NOT NULL, position INTEGER NOT NULL, added_at INTEGER NOT NULL, PRIMARY KEY (playlist_id, track_id))",
+        "CREATE INDEX PlaylistTracksPosition ON PlaylistTracks(playlist_id, position)",
+        migrate_memberships,
+        "ALTER TABLE Users DROP COLUMN playlists",
+        "ALTER TABLE Playlists DROP COLUMN tracks",
+    ],
+    [
+        "CREATE TABLE SearchCache (query TEXT PRIMARY KEY, expires_at REAL NOT NULL, data TEXT NOT NULL)",
+    ],
+    [
+        "CREATE TABLE VideoLinks (query TEXT PRIMARY KEY, expires_at REAL NOT NULL, data TEXT NOT NULL)",
+        "CREATE TABLE YoutubeQuota (day TEXT PRIMARY KEY, used INTEGER NOT NULL)",
+    ],
+    ["ALTER TABLE Tracks ADD COLUMN cover_file_id TEXT"],
+    ["ALTER TABLE Playlists ADD COLUMN logo_file_id TEXT"],
+    [
+        "CREATE TABLE AudioFiles (track_id INTEGER NOT NULL, format TEXT NOT NULL, size INTEGER NOT NULL, last_access REAL NOT NULL, PRIMARY KEY (track_id, format))",
+        "CREATE INDEX AudioFilesLastAccess ON AudioFiles(last_access)",
+    ],
+    [
+        "CREATE INDEX TracksTitle ON Tracks(title)",
+        # Trigram tokens match any part of a word, so a misspelled query still
+        # shares most of its tokens with the right track (SQLite 3.34+)
+        "CREATE VIRTUAL TABLE TracksSearch USING fts5(title, artists, content='Tracks', content_rowid='id', tokenize='trigram')",
+        "INSERT INTO TracksSearch(TracksSearch) VALUES ('rebuild')",
+        "CREATE TRIGGER TracksSearchInsert AFTER INSERT ON Tracks BEGIN INSERT INTO TracksSearch(rowid, title, artists) VALUES (new.id, new.title, new.artists); END",
+        "CREATE TRIGGER TracksSearchDelete AFTER DELETE ON Tracks BEGIN INSERT INTO TracksSearch(TracksSearch, rowid, title, artists) VALUES ('delete', old.id, old.title, old.artists); END",
+        "CREATE TRIGGER TracksSearchUpdate AFTER UPDATE OF title, artists ON Tracks BEGIN INSERT INTO TracksSearch(TracksSearch, rowid, title, artists) VALUES ('delete', old.id, old.title, old.artists); INSERT INTO TracksSearch(rowid, title, artists) VALUES (new.id, new.title, new.artists); END",
+    ],
+    [
+        merge_duplicate_tracks,
+        "DROP INDEX TracksTitle",
+        "CREATE UNIQUE INDEX TracksIdentity ON Tracks(artists, title)",
+    ],
+    [
+        "CREATE TABLE FsmState (key TEXT PRIMARY KEY, state TEXT, data TEXT NOT NULL DEFAULT '{}')",
+        "CREATE TABLE CacheRevisions (name TEXT PRIMARY KEY, revision INTEGER NOT NULL)",
+    ],
+    [
+        # Searches now keep several tracks per query
+        "DELETE FROM SearchCache",
+        "CREATE TABLE VideoSearches (query TEXT PRIMARY KEY, expires_at REAL NOT NULL, data TEXT NOT NULL)",
+    ],
+    [
+        "ALTER TABLE Tracks ADD COLUMN link_checked_at INTEGER",
+        "ALTER TABLE Tracks ADD COLUMN link_failures INTEGER NOT NULL DEFAULT 0",
+        "CREATE INDEX TracksLinkChecked ON Tracks(link_checked_at)",
+    ],
+    [
+        # Logos are uploaded again, so their file_unique_ids get stored
+        "ALTER TABLE Playlists ADD COLUMN logo_file_unique_id TEXT",
+        "UPDATE Playlists SET logo_file_id = NULL",
+    ],
+]
+
+
+def init_db(con):
+    sql = "CREATE TABLE IF NOT EXISTS Users (id INTEGER UNIQUE, playlists TEXT)"
+    con.execute(sql)
+    sql = "CREATE TABLE IF NOT EXISTS Playlists (id INTEGER PRIMARY KEY, name TEXT, logo BLOB, tracks TEXT)"
+    con.execute(sql)
+    sql = "CREATE TABLE IF NOT EXISTS Tracks (id INTEGER PRIMARY KEY, title TEXT, artists TEXT, cover_link TEXT, yt_link TEXT)"
+    con.execute(sql)
+    version = con.execute("PRAGMA user_version").fetchone()[0]
+    for version, migration in enumerate(MIGRATIONS[version:], version + 1):
+        for step in migration:
+            if callable(step):
+                step(con)
+            else:
+                con.execute(step)
+        con.execute(f"PRAGMA user_version = {version}")
+
+
+def select_page(con, sql, params, key, total, page, anchor):
+    # Pages are read by keyset on the position column: anchor is ">N" for the
+    # page after position N, "<N" for the page before it, or "-" for the
+    # first/last page when wrapping around. The position must be the last
+    # column of the rows selected by sql.
+    pages = max(ceil(total / PAGE_SIZE), 1)
+    if not 0 <= page < pages:
+        page = 0 if page > 0 else pages - 1
+        anchor = "-"
+    if anchor.startswith(">"):
+        sql = f"{sql} AND {key} > ? ORDER BY {key} LIMIT ?"
+        rows = con.execute(sql, [*params, int(anchor[1:]), PAGE_SIZE]).fetchall()
+    elif anchor.startswith("<"):
+        sql = f"{sql} AND {key} < ? ORDER BY {key} DESC LIMIT ?"
+        rows = con.execute(sql, [*params, int(anchor[1:]), PAGE_SIZE]).fetchall()
+        rows.reverse()
+    elif page == 0:
+        sql = f"{sql} ORDER BY {key} LIMIT ?"
+        rows = con.execute(sql, [*params, PAGE_SIZE]).fetchall()
+    elif page == pages - 1:
+        sql = f"{sql} ORDER BY {key} DESC LIMIT ?"
+        rows = con.execute(sql, [*params, total - page * PAGE_SIZE]).fetchall()
+        rows.reverse()
+    else:
+        sql = f"{sql} ORDER BY {key} LIMIT ? OFFSET ?"
+        rows = con.execute(sql, [*params, PAGE_SIZE, page * PAGE_SIZE]).fetchall()
+    return page, rows
+
+
+async def add_user(user_id):
+    await db.execute("INSERT OR IGNORE INTO Users(id) VALUES (?)", [user_id])
+
+
+async def get_user_playlists_page(user_id, page, anchor="-"):
+    def query(con):
+        sql = "SELECT COUNT(*) FROM UserPlaylists WHERE user_id = ?"
+        total = con.execute(sql, [user_id]).fetchone()[0]
+        sql = """SELECT p.id, p.name, up.position FROM UserPlaylists AS up
+                 JOIN Playlists AS p ON p.id = up.playlist_id
+                 WHERE up.user_id = ?"""
+        return total, *select_page(con, sql, [user_id], "up.position", total, page, anchor)
+
+    return await db.read(query)
+
+
+async def get_playlists_to_add_page(user_id, track_id, page, anchor="-"):
+    def query(con):
+        where = """WHERE up.user_id = ? AND NOT EXISTS (
+                       SELECT 1 FROM PlaylistTracks AS pt
+                       WHERE pt.playlist_id = up.playlist_id AND pt.track_id = ?
+                   )"""
+        sql = f"SELECT COUNT(*) FROM UserPlaylists AS up {where}"
+        total = con.execute(sql, [user_id, track_id]).fetchone()[0]
+        sql = f"""SELECT p.id, p.name, up.position FROM UserPlaylists AS up
+                  JOIN Playlists AS p ON p.id = up.playlist_id {where}"""
+        return total, *select_page(
+            con, sql, [user_id, track_id], "up.position", total, page, anchor
+        )
+
+    return await db.read(query)
+
+
+async def create_playlist(user_id, name, logo):
+    def query(con):
+        sql = "INSERT INTO Playlists(name, logo) VALUES (?, ?)"
+        playlist_id = con.execute(sql, [name, logo]).lastrowid
+        sql = """INSERT INTO UserPlaylists(user_id, playlist_id, position, added_at)
+                 SELECT ?, ?, COALESCE(MAX(position) + 1, 0), ?
+                 FROM UserPlaylists WHERE user_id = ?"""
+        con.execute(sql, [user_id, playlist_id, int(time.time()), user_id])
+        return playlist_id
+
+    return await db.write(query)
+
+
+async def get_playlist(playlist_id):
+    sql = "SELECT name, logo_file_id, logo_file_unique_id FROM Playlists WHERE id = ?"
+    return await db.fetchone(sql, [playlist_id])
+
+
+async def get_playlist_logo(playlist_id):
+    sql = "SELECT logo FROM Playlists WHERE id = ?"
+    return (await db.fetchone(sql, [playlist_id]))[0]
+
+
+async def set_playlist_logo_file_id(playlist_id, file_id, file_unique_id):
+    sql = "UPDATE Playlists SET logo_file_id = ?, logo_file_unique_id = ? WHERE id = ?"
+    await db.execute(sql, [file_id, file_unique_id, playlist_id])
+
+
+async def get_playlist_tracks_page(playlist_id, page, anchor="-"):
+    def query(con):
+        sql = "SELECT COUNT(*) FROM PlaylistTracks WHERE playlist_id = ?"
+        total = con.execute(sql, [playlist_id]).fetchone()[0]
+        sql = """SELECT t.id, t.artists, t.title, pt.position FROM PlaylistTracks AS pt
+                 JOIN Tracks AS t ON t.id = pt.track_id
+                 WHERE pt.playlist_id = ?"""
+        return total, *select_page(
+            con, sql, [playlist_id], "pt.position", total, page, anchor
+        )
+
+    return await db.read(query)
+
+
+async def add_track_to_playlist(playlist_id, track_id):
+    sql = """INSERT OR IGNORE INTO PlaylistTracks(playlist_id, track_id, position, added_at)
+             SELECT ?, ?, COALESCE(MAX(position) + 1, 0), ?
+             FROM PlaylistTracks WHERE playlist_id = ?"""
+    await db.execute(sql, [playlist_id, track_id, int(time.time()), playlist_id])
+
+
+async def get_track(track_id):
+    sql = "SELECT title, artists, cover_link, yt_link, file_id, cover_file_id FROM Tracks WHERE id = ?"
+    return await db.fetchone(sql, [track_id])
+
+
+async def find_track(artists, title):
+    sql = "SELECT id, yt_link, cover_file_id, file_id FROM Tracks WHERE artists = ? AND title = ?"
+    return await db.fetchone(sql, [artists, title])
+
+
+async def get_tracks_after(track_id):
+    sql = "SELECT id, title, artists, cover_link, yt_link, file_id FROM Tracks WHERE id > ? ORDER BY id"
+    return await db.fetchall(sql, [track_id])
+
+
+def trigram_query(text):
+    # Any shared trigram makes a candidate, bm25 ranks the ones sharing the
+    # most of them first
+    trigrams = []
+    for word in text.split():
+        for i in range(len(word) - 2):
+            trigram = '"' + word[i : i + 3].replace('"', '""') + '"'
+            if trigram not in trigrams:
+                trigrams.append(trigram)
+    return " OR ".join(trigrams[:32])
+
+
+async def search_tracks(text, limit=20):
+    match = trigram_query(text)
+    if not match:
+        return []
+    sql = """SELECT Tracks.id, Tracks.title, Tracks.artists, Tracks.cover_link, Tracks.yt_link, Tracks.cover_file_id, Tracks.file_id
+             FROM TracksSearch JOIN Tracks ON Tracks.id = TracksSearch.rowid
+             WHERE TracksSearch MATCH ? ORDER BY rank LIMIT ?"""
+    return await db.fetchall(sql, [match, limit])
+
+
+async def add_track(title, artists, cover_link, yt_link):
+    # A track stored meanwhile by another search wins, its id is returned
+    sql = """INSERT INTO Tracks(title, artists, cover_link, yt_link) VALUES (?, ?, ?, ?)
+             ON CONFLICT(artists, title) DO UPDATE SET yt_link = COALESCE(Tracks.yt_link, excluded.yt_link)
+             RETURNING id, yt_link, cover_file_id, file_id"""
+    params = [title, artists, cover_link, yt_link]
+    return await db.write(lambda con: con.execute(sql, params).fetchone())
+
+
+async def set_track_file_id(track_id, file_id):
+    sql = "UPDATE Tracks SET file_id = ? WHERE id = ?"
+    await db.execute(sql, [file_id, track_id])
+
+
+async def set_track_cover_file_id(track_id, file_id):
+    sql = "UPDATE Tracks SET cover_file_id = ? WHERE id = ?"
+    await db.execute(sql, [file_id, track_id])
+
+
+async def claim_links(limit, recheck_after, retry_after):
+    # Marks a batch of tracks whose links are due for a check as checked now
+    # and returns them, so other bot processes don't check them too. Links
+    # never checked come first, failing ones are due again sooner the fewer
+    # times they failed.
+    sql = """UPDATE Tracks SET link_checked_at = :now WHERE id IN (
+               SELECT id FROM Tracks
+               WHERE link_checked_at IS NULL OR link_checked_at < :now - CASE link_failures
+                 WHEN 0 THEN :recheck ELSE MIN(:recheck, :retry * link_failures) END
+               ORDER BY link_checked_at LIMIT :limit)
+             RETURNING id, title, artists, yt_link, link_failures"""
+    params = {
+        "now": int(time.time()),
+        "recheck": recheck_after,
+        "retry": retry_after,
+        "limit": limit,
+    }
+    return await db.write(lambda con: con.execute(sql, params).fetchall())
+
+
+async def set_link_failures(track_id, failures):
+    sql = "UPDATE Tracks SET link_failures = ? WHERE id = ?"
+    await db.execute(sql, [failures, track_id])
+
+
+async def replace_track_link(track_id, yt_link):
+    sql = "UPDATE Tracks SET yt_link = ?, link_failures = 0 WHERE id = ?"
+    await db.execute(sql, [yt_link, track_id])
+
+
+async def flag_track_link(track_id):
+    # The link is checked with the next batch
+    sql = "UPDATE Tracks SET link_checked_at = NULL WHERE id = ?"
+    await db.execute(sql, [track_id])
+
+
+async def load_cached(table, query):
+    sql = f"SELECT expires_at, data FROM {table} WHERE query = ?"
+    return await db.fetchone(sql, [query])
+
+
+async def store_cached(table, query, expires_at, data):
+    sql = f"""INSERT INTO {table}(query, expires_at, data) VALUES (?, ?, ?)
+              ON CONFLICT(query) DO UPDATE SET expires_at = excluded.expires_at, data = excluded.data"""
+    await db.execute(sql, [query, expires_at, data])
+
+
+async def purge_cache(table):
+    sql = f"DELETE FROM {table} WHERE expires_at < ?"
+    await db.execute(sql, [time.time()])
+
+
+async def reserve_quota(day, units, budget):
+    sql = """INSERT INTO YoutubeQuota(day, used) VALUES (?, ?)
+             ON CONFLICT(day) DO UPDATE SET used = used + excluded.used
+             WHERE used + excluded.used <= ?"""
+    return await db.write(lambda con: con.execute(sql, [day, units, budget]).rowcount > 0)
+
+
+async def refund_quota(day, units):
+    sql = "UPDATE YoutubeQuota SET used = MAX(used - ?, 0) WHERE day = ?"
+    await db.execute(sql, [units, day])
+
+
+async def exhaust_quota(day, budget):
+    sql = """INSERT INTO YoutubeQuota(day, used) VALUES (?, ?)
+             ON CONFLICT(day) DO UPDATE SET used = MAX(used, excluded.used)"""
+    await db.execute(sql, [day, budget])
+
+
+async def get_audio_files():
+    return await db.fetchall("SELECT track_id, format FROM AudioFiles")
+
+
+async def get_audio_file(track_id):
+    sql = "SELECT format FROM AudioFiles WHERE track_id = ? ORDER BY last_access DESC LIMIT 1"
+    return await db.fetchone(sql, [track_id])
+
+
+async def get_audio_cache_size():
+    return (await db.fetchone("SELECT COALESCE(SUM(size), 0) FROM AudioFiles"))[0]
+
+
+async def get_oldest_audio_files(limit, accessed_before, offset=0):
+    sql = "SELECT track_id, format, size FROM AudioFiles WHERE last_access < ? ORDER BY last_access LIMIT ? OFFSET ?"
+    return await db.fetchall(sql, [accessed_before, limit, offset])
+
+
+async def add_audio_file(track_id, fmt, size, last_access):
+    sql = """INSERT INTO AudioFiles(track_id, format, size, last_access) VALUES (?, ?, ?, ?)
+             ON CONFLICT(track_id, format) DO UPDATE SET size = excluded.size, last_access = excluded.last_access"""
+    await db.execute(sql, [track_id, fmt, size, last_access])
+
+
+async def touch_audio_file(track_id, fmt, last_access):
+    sql = "UPDATE AudioFiles SET last_access = ? WHERE track_id = ? AND format = ?"
+    await db.execute(sql, [last_access, track_id, fmt])
+
+
+async def remove_audio_file(track_id, fmt):
+    sql = "DELETE FROM AudioFiles WHERE track_id = ? AND format = ?"
+    await db.execute(sql, [track_id, fmt])
+
+
+db = Database(
+    getenv("DB_PATH", "data/db/music.db"),
+    int(getenv("DB_READERS", "4")),
+)
+
+
+async def get_fsm_state(key):
+    row = await db.fetchone("SELECT state FROM FsmState WHERE key = ?", [key])
+    return row[0] if row is not None else None
+
+
+async def get_fsm_data(key):
+    row = await db.fetchone("SELECT data FROM FsmState WHERE key = ?", [key])
+    return json.loads(row[0]) if row is not None else {}
+
+
+def clear_fsm_state(con, key):
+    sql = "DELETE FROM FsmState WHERE key = ? AND state IS NULL AND data = '{}'"
+    con.execute(sql, [key])
+
+
+async def set_fsm_state(key, state):
+    def query(con):
+        sql = """INSERT INTO FsmState(key, state) VALUES (?, ?)
+                 ON CONFLICT(key) DO UPDATE SET state = excluded.state"""
+        con.execute(sql, [key, state])
+        clear_fsm_state(con, key)
+
+    await db.write(query)
+
+
+async def set_fsm_data(key, data):
+    def query(con):
+        sql = """INSERT INTO FsmState(key, data) VALUES (?, ?)
+                 ON CONFLICT(key) DO UPDATE SET data = excluded.data"""
+        con.execute(sql, [key, json.dumps(data)])
+        clear_fsm_state(con, key)
+
+    await db.write(query)
+
+
+async def update_fsm_data(key, update):
+    # Read and written in one transaction, so concurrent updates from other
+    # processes can't overwrite each other's keys
+    def query(con):
+        row = con.execute("SELECT data FROM FsmState WHERE key = ?", [key]).fetchone()
+        data = json.loads(row[0]) if row is not None else {}
+        data.update(update)
+        sql = """INSERT INTO FsmState(key, data) VALUES (?, ?)
+                 ON CONFLICT(key) DO UPDATE SET data = excluded.data"""
+        con.execute(sql, [key, json.dumps(data)])
+        clear_fsm_state(con, key)
+        return data
+
+    return await db.write(query)
+
+
+async def get_cache_revision(name):
+    sql = "SELECT revision FROM CacheRevisions WHERE name = ?"
+    row = await db.fetchone(sql, [name])
+    return row[0] if row is not None else 0
+
+
+async def bump_cache_revision(name):
+    sql = """INSERT INTO CacheRevisions(name, revision) VALUES (?, 1)
+             ON CONFLICT(name) DO UPDATE SET revision = revision + 1"""
+    await db.execute(sql, [name])
@@ -0,0 +1,77 @@
+import asyncio
+import importlib
+import os
+import resource
+import sys
+import time
+
+# What the bot imports, in the order it imports it, and when. The libraries
+# loaded on first use are left out of the start of the bot and of the
+# memory of processes that never need them.
+SUBSYSTEMS = [
+    ("aiohttp", ("aiohttp", "aiohttp.web"), "startup"),
+    ("aiogram", ("aiogram", "aiogram.types", "aiogram.methods"), "startup"),
+    ("database", ("handlers.db", "handlers.repository"), "startup"),
+    ("rapidfuzz", ("rapidfuzz.fuzz", "rapidfuzz.process"), "startup"),
+    ("downloads", ("handlers.audio_cache", "handlers.downloads"), "startup"),
+    ("handlers", ("handlers.base", "handlers.playlists", "handlers.tracks"), "startup"),
+    ("webhook", ("handlers.webhook",), "startup"),
+    ("pillow", ("PIL.Image", "PIL.ImageDraw"), "first playlist logo"),
+    ("numpy", ("numpy",), "first remote search"),
+    ("pyyoutube", ("pyyoutube",), "first youtube api search"),
+    ("yt-dlp", ("yt_dlp",), "first download, in workers"),
+]
+
+
+def include_routers(dp):
+    from . import base, playlists, tracks
+
+    dp.include_routers(base.router, playlists.router, tracks.router)
+
+
+def rss():
+    # Resident memory in bytes, the peak where /proc isn't available
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def measure(fn):
+    memory = rss()
+    start = time.perf_counter()
+    fn()
+    return time.perf_counter() - start, rss() - memory
+
+
+def profile_startup():
+    # Imports every subsystem in turn, then runs the startup hooks, and
+    # prints the time and resident memory each of them took
+    rows = []
+    for name, modules, loaded in SUBSYSTEMS:
+        seconds, memory = measure(
+            lambda: [importlib.import_module(module) for module in modules]
+        )
+        rows.append((name, loaded, seconds, memory))
+    from .base import bot, dp
+
+    include_routers(dp)
+
+    async def hooks():
+        await dp.emit_startup(bot=bot)
+        await dp.emit_shutdown(bot=bot)
+
+    seconds, memory = measure(lambda: asyncio.run(hooks()))
+    loaded_at_startup = sum(loaded == "startup" for _, _, loaded in SUBSYSTEMS)
+    rows.insert(loaded_at_startup, ("startup hooks", "startup", seconds, memory))
+    print(f"{'subsystem':20} {'loaded on':28} {'import ms':>10} {'RSS MB':>8}")
+    for name, loaded, seconds, memory in rows:
+        print(f"{name:20} {loaded:28} {seconds * 1000:10.1f} {memory / 2**20:8.1f}")
+    startup = [row for row in rows if row[1] == "startup"]
+    print(
+        f"{'total at startup':49} {sum(row[2] for row in startup) * 1000:10.1f}"
+        f" {sum(row[3] for row in startup) / 2**20:8.1f}"
+    )
+    print(f"{'process RSS':49} {'':10} {rss() / 2**20:8.1f}")
+    print(f"python {sys.version.split()[0]}, {len(sys.modules)} modules loaded")
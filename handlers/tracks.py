@@ -1,67 +1,67 @@
-import os
-from math import ceil
+import asyncio
+import time
+from urllib.parse import urljoin
 
-import yt_dlp
-from aiogram import F, html
+from aiogram import F, Router, html
+from aiogram.exceptions import TelegramBadRequest
 from aiogram.fsm.context import FSMContext
 from aiogram.types import (
     CallbackQuery,
     FSInputFile,
+    InlineQuery,
+    InlineQueryResultArticle,
+    InlineQueryResultCachedAudio,
     InputMediaPhoto,
+    InputTextMessageContent,
     Message,
-    URLInputFile,
 )
 from aiogram.utils.keyboard import InlineKeyboardBuilder
-from thefuzz import fuzz
+from rapidfuzz import fuzz, utils
 
 from .base import *
+from .cache import MISSING, normalize_query
+from .downloads import DownloadError
+from .matching import query_scores, video_scores
 from .playlists import fetch_tracks
 
+router = Router(name=__name__)
 
-def fetch_playlists_to_add(user_id, track_id, page):
+
+async def fetch_playlists_to_add(user_id, track_id, page, anchor="-"):
+    revision = await keyboards.revision(("user", user_id))
+    cached = keyboards.get(("add", user_id, track_id, page), revision)
+    if cached is not None:
+        return cached
+    total, page, playlists = await get_playlists_to_add_page(
+        user_id, track_id, page, anchor
+    )
     keyboard = InlineKeyboardBuilder()
     layout = [1]
-    playlists = cur.execute(
-        "SELECT playlists FROM Users WHERE id = ?", [user_id]
-    ).fetchone()[0]
     if playlists:
-        playlists = list(map(int, playlists.split(", ")))
-        playlists_data = cur.execute(
-            f"SELECT id, name, tracks FROM Playlists WHERE id IN ({', '.join('?' for _ in playlists)})",
-            playlists,
-        ).fetchall()
-        names, playlists = [], []
-        for playlist_id, name, tracks in playlists_data:
-            if str(track_id) not in tracks.split(", "):
-                playlists.append(playlist_id)
-                names.append(name)
-        if page == ceil(len(playlists) / 5):
-            page = 0
-        elif page == -1:
-            page = len(playlists) // 5
-        for i, name in enumerate(names[page * 5 : page * 5 + 5]):
+        for playlist_id, name, _ in playlists:
             keyboard.button(
                 text=name,
                 callback_data=Callback(
                     action="add",
                     obj="to_playlist",
-                    data=f"{playlists[page * 5 + i]} {track_id}",
+                    data=f"{playlist_id} {track_id}",
                 ).pack(),
             )
-        if len(names) > 5:
+        if total > PAGE_SIZE:
+            left, right = page_anchors(total, page, playlists)
             keyboard.button(
                 text="⬅️",
                 callback_data=Callback(
-                    action="page_add", obj="left", data=f"{page} {track_id}"
+                    action="page_add", obj="left", data=f"{track_id} {left}"
                 ).pack(),
             )
             keyboard.button(
                 text="➡️",
                 callback_data=Callback(
-                    action="page_add", obj="right", data=f"{page} {track_id}"
+                    action="page_add", obj="right", data=f"{track_id} {right}"
                 ).pack(),
             )
-        layout = [1 for _ in names[page * 5 : page * 5 + 5]] + [2, 1]
+        layout = [1 for _ in playlists] + [2, 1]
     keyboard.button(
         text="Cancel",
         callback_data=Callback(
@@ -70,11 +70,40 @@ def fetch_playlists_to_add(user_id, track_id, page):
     )
     keyboard.adjust(*layout)
     keyboard_markup = keyboard.as_markup()
-    return len(playlists), keyboard_markup, page + 1
+    result = total, keyboard_markup, page + 1
+    keyboards.put(
+        ("add", user_id, track_id, page), result, ("user", user_id), revision
+    )
+    return result
+
+
+async def search_local_track(name):
+    # Candidates sharing trigrams with the query are rescored as a whole,
+    # only a near match is trusted over the remote search
+    query = normalize_query(name)
+    best, best_score = None, 0
+    for track in await search_tracks(query):
+        _, title, artists, *_ = track
+        score = max(
+            fuzz.ratio(query, title.casefold()),
+            fuzz.token_sort_ratio(
+                query, f"{artists} {title}", processor=utils.default_process
+            ),
+        )
+        if score > best_score:
+            best, best_score = track, score
+    if best_score < LOCAL_SEARCH_SCORE:
+        return None
+    return best
 
 
 async def search_track_metadata(name):
-    track_metadata_uri = "https://music.yandex.ru/handlers/music-search.jsx"
+    # Up to SEARCH_CANDIDATES tracks found for the query, best first
+    query = normalize_query(name)
+    tracks = await metadata_cache.get(query)
+    if tracks is not MISSING:
+        return tracks or []
+    track_metadata_uri = urljoin(YANDEX_MUSIC_URL, "/handlers/music-search.jsx")
     response = await get_json_response(
         track_metadata_uri,
         params={
@@ -83,95 +112,100 @@ async def search_track_metadata(name):
         },
     )
     if response is None:
-        return None
-    tracks = response["tracks"]["items"]
+        return []
+    tracks = []
+    for track in response["tracks"]["items"][:SEARCH_CANDIDATES]:
+        artists = []
+        for artist in track["artists"]:
+            artists.append(artist["name"])
+        # coverUri has no scheme, covers are fetched the same way as the search
+        cover_link = urljoin(
+            YANDEX_MUSIC_URL, "//" + track["coverUri"][:-2] + "300x300"
+        )
+        duration = track.get("durationMs")
+        tracks.append(
+            {
+                "title": track["title"],
+                "artists": ", ".join(artists),
+                "cover_link": cover_link,
+                "duration": duration / 1000 if duration else None,
+            }
+        )
+    await metadata_cache.put(query, tracks or None)
+    return tracks
+
+
+async def search_remote_tracks(query):
+    # Yandex Music and YouTube are searched at once and every track found is
+    # scored against every video found. Tracks are ranked by how well they
+    # match the query and their best video, tracks with no good enough video
+    # get one searched for them alone once they're chosen.
+    tracks, videos = await asyncio.gather(
+        search_track_metadata(query), link_resolver.search_videos(query)
+    )
     if not tracks:
-        return None
-    track = tracks[0]
-    title = track["title"]
-    artists = []
-    artists_data = track["artists"]
-    for artist in artists_data:
-        artists.append(artist["name"])
-    cover_link = "https://" + track["coverUri"][:-2] + "300x300"
-    track_data = {
-        "title": title,
-        "artists": ", ".join(artists),
-        "cover_link": cover_link,
-    }
-    return track_data
-
-
-def search_track_link(title, artists):
-    yt_video = yt_api.search(q=f"{artists} - {title}", count=1, limit=1, return_json=True, search_type="video")["items"]  # type: ignore
-    if not yt_video:
-        return None
-    yt_video = yt_video[0]
-    yt_link = "https://www.youtube.com/watch?v=" + yt_video["id"]["videoId"]
-    yt_title = yt_video["snippet"]["title"]
-    if fuzz.partial_ratio(yt_title.lower(), title.lower()) < 70:
-        return None
-    return yt_link
+        return []
+    keys = [(track["title"], track["artists"], track["duration"]) for track in tracks]
+    scores, matches = await asyncio.gather(
+        asyncio.to_thread(video_scores, keys, videos),
+        asyncio.to_thread(query_scores, query, keys),
+    )
+    candidates = []
+    for track, row, match in zip(tracks, scores, matches):
+        yt_link = link_resolver.best_link(row, videos)
+        score = 0.6 * float(match) + 0.4 * (float(row.max()) if yt_link else 0)
+        candidates.append({**track, "yt_link": yt_link, "score": round(score, 1)})
+    # Stable, the search's own order decides between equal scores
+    candidates.sort(key=lambda candidate: -candidate["score"])
+    return candidates
 
 
-@dp.message(F.text.casefold() == "track search")
-async def search_track_handler(message: Message, state: FSMContext):
-    await state.set_state(States.track_name)
-    await message.answer_photo(photo=waiting_img, caption="Type the track name")
+async def store_remote_track(title, artists, cover_link, duration, yt_link):
+    track = await find_track(artists, title)
+    if track is None:
+        if yt_link is None:
+            yt_link = await link_resolver.resolve(title, artists, duration)
+            if yt_link is None:
+                return None
+        else:
+            await link_resolver.remember(title, artists, yt_link)
+        track = await add_track(title, artists, cover_link, yt_link)
+        track_index.add(track[0], title, artists, cover_link, track[1], track[3])
+    track_id, yt_link, cover_file_id, file_id = track
+    return track_id, title, artists, cover_link, yt_link, cover_file_id, file_id
 
 
-@dp.message(States.track_name)
-async def searching_track_handler(message: Message, state: FSMContext):
-    await state.clear()
-    msg = await message.answer_photo(
-        photo=waiting_img,
-        caption=html.italic("Searching..."),
+async def store_candidate(candidate):
+    # Users choosing the same track at once share its link lookup
+    title, artists = candidate["title"], candidate["artists"]
+    return await searches.run(
+        ("track", artists, title),
+        store_remote_track,
+        title,
+        artists,
+        candidate["cover_link"],
+        candidate["duration"],
+        candidate["yt_link"],
     )
-    data = await search_track_metadata(message.text)
-    if data is None:
-        keyboard = InlineKeyboardBuilder()
-        keyboard.button(
-            text="Try again",
-            callback_data=Callback(action="search", obj="track", data="").pack(),
-        )
-        keyboard.adjust(1)
-        keyboard_markup = keyboard.as_markup()
-        logo = InputMediaPhoto(
-            media=error_img,
-            caption="Nothing was found for this request",
-        )
-        await msg.edit_media(logo, reply_markup=keyboard_markup)
-        return
-    tracks = cur.execute(
-        "SELECT * FROM Tracks WHERE title = ?", [data["title"]]
-    ).fetchall()
-    if not tracks:
-        yt_link = search_track_link(data["title"], data["artists"])
-        if yt_link is None:
-            keyboard = InlineKeyboardBuilder()
-            keyboard.button(
-                text="Try again",
-                callback_data=Callback(action="search", obj="track", data="").pack(),
-            )
-            keyboard.adjust(1)
-            keyboard_markup = keyboard.as_markup()
-            logo = InputMediaPhoto(
-                media=error_img,
-                caption="Nothing was found for this request",
-            )
-            await msg.edit_media(logo, reply_markup=keyboard_markup)
-            return
-        data["yt_link"] = yt_link
-        sql = "INSERT INTO Tracks(title, artists, cover_link, yt_link) VALUES (?, ?, ?, ?)"
-        cur.execute(
-            sql, [data["title"], data["artists"], data["cover_link"], data["yt_link"]]
-        )
-        track_id = cur.lastrowid
-        con.commit()
-    else:
-        track = tracks[0]
-        data["yt_link"] = track[4]
-        track_id = track[0]
+
+
+async def show_nothing_found(message):
+    keyboard = InlineKeyboardBuilder()
+    keyboard.button(
+        text="Try again",
+        callback_data=Callback(action="search", obj="track", data="").pack(),
+    )
+    keyboard.adjust(1)
+    keyboard_markup = keyboard.as_markup()
+    logo = InputMediaPhoto(
+        media=error_img,
+        caption="Nothing was found for this request",
+    )
+    await message.edit_media(logo, reply_markup=keyboard_markup)
+
+
+async def show_found_track(message, track):
+    track_id, title, artists, cover_link, yt_link, cover_file_id, file_id = track
     keyboard = InlineKeyboardBuilder()
     keyboard.button(
         text="Download",
@@ -189,19 +223,92 @@ async def searching_track_handler(message: Message, state: FSMContext):
     )
     keyboard.adjust(1, 1, 1)
     keyboard_markup = keyboard.as_markup()
-    cover = URLInputFile(
-        data["cover_link"],
-        filename="cover.png",
+    caption = html.link(f"{artists} - {title}", yt_link)
+    await edit_track_cover(
+        message, track_id, cover_link, cover_file_id, caption, keyboard_markup
+    )
+    # Most users press Download right away, the file is fetched while they
+    # read the card unless it's already on Telegram
+    if file_id is None:
+        await downloader.prefetch(track_id, yt_link)
+
+
+async def show_track_picker(message, state, picks):
+    # The candidates are kept with the id of the message showing them, a
+    # newer search replaces them
+    await state.update_data(picks=picks, picker=message.message_id)
+    keyboard = InlineKeyboardBuilder()
+    for i, pick in enumerate(picks):
+        keyboard.button(
+            text=f"{pick['artists']} - {pick['title']}",
+            callback_data=Callback(action="pick", obj="track", data=str(i)).pack(),
+        )
+    keyboard.button(
+        text="Try again",
+        callback_data=Callback(action="search", obj="track", data="").pack(),
     )
-    caption = html.link(f"{data['artists']} - {data['title']}", data["yt_link"])
-    cover = InputMediaPhoto(
-        media=cover,
-        caption=caption,
+    keyboard.adjust(1)
+    logo = InputMediaPhoto(
+        media=waiting_img,
+        caption="Several tracks match, which one is it?",
     )
-    await msg.edit_media(cover, reply_markup=keyboard_markup)
+    await message.edit_media(logo, reply_markup=keyboard.as_markup())
 
 
-@dp.callback_query(Callback.filter((F.action == "search") & (F.obj == "track")))
+@router.message(F.text.casefold() == "track search")
+async def search_track_handler(message: Message, state: FSMContext):
+    await state.set_state(States.track_name)
+    await message.answer_photo(photo=waiting_img, caption="Type the track name")
+
+
+@router.message(States.track_name)
+async def searching_track_handler(message: Message, state: FSMContext):
+    await state.clear()
+    msg = await message.answer_photo(
+        photo=waiting_img,
+        caption=html.italic("Searching..."),
+    )
+    track = await search_local_track(message.text)
+    if track is None:
+        query = normalize_query(message.text)
+        candidates = await searches.run(("query", query), search_remote_tracks, query)
+        if not candidates:
+            await show_nothing_found(msg)
+            return
+        # Tracks about as good as the best one are left for the user to pick
+        picks = [
+            candidate
+            for candidate in candidates
+            if candidate["score"] >= candidates[0]["score"] - PICK_MARGIN
+        ]
+        if len(picks) > 1:
+            await show_track_picker(msg, state, picks)
+            return
+        track = await store_candidate(candidates[0])
+    if track is None:
+        await show_nothing_found(msg)
+        return
+    await show_found_track(msg, track)
+
+
+@router.callback_query(Callback.filter((F.action == "pick") & (F.obj == "track")))
+async def pick_track_handler(
+    query: CallbackQuery, callback_data: Callback, state: FSMContext
+):
+    data = await state.get_data()
+    if data.get("picker") != query.message.message_id:  # type: ignore
+        # Picked from the results of an older search
+        await show_nothing_found(query.message)
+        return
+    await state.clear()
+    track = await store_candidate(data["picks"][int(callback_data.data)])
+    if track is None:
+        await show_nothing_found(query.message)
+        return
+    await show_found_track(query.message, track)
+
+
+@router.callback_query(Callback.filter((F.action == "search") & (F.obj == "track")))
 async def search_track_again_handler(query: CallbackQuery, state: FSMContext):
     await state.set_state(States.track_name)
     logo = InputMediaPhoto(
@@ -211,10 +318,12 @@ async def search_track_again_handler(query: CallbackQuery, state: FSMContext):
     await query.message.edit_media(logo)  # type: ignore
 
 
-@dp.callback_query(Callback.filter((F.action == "add") & (F.obj == "track")))
+@router.callback_query(Callback.filter((F.action == "add") & (F.obj == "track")))
 async def add_track_handler(query: CallbackQuery, callback_data: Callback):
     track_id = int(callback_data.data)
-    playlists, markup, _ = fetch_playlists_to_add(query.from_user.id, track_id, 0)
+    playlists, markup, _ = await fetch_playlists_to_add(
+        query.from_user.id, track_id, 0
+    )
     logo = InputMediaPhoto(
         media=waiting_img,
         caption=f"{html.bold('Select a playlist')}\nTotal: {playlists}, Page: 1",
@@ -225,31 +334,21 @@ async def add_track_handler(query: CallbackQuery, callback_data: Callback):
     )
 
 
-@dp.callback_query(Callback.filter((F.action == "add") & (F.obj == "to_playlist")))
+@router.callback_query(Callback.filter((F.action == "add") & (F.obj == "to_playlist")))
 async def adding_track_handler(query: CallbackQuery, callback_data: Callback):
     playlist_id, track_id = map(int, callback_data.data.split())
-    sql = "SELECT tracks FROM Playlists WHERE id = ?"
-    tracks = cur.execute(sql, [playlist_id]).fetchone()[0]
-    if tracks == "":
-        tracks = str(track_id)
-    else:
-        tracks += f", {track_id}"
-    sql = "UPDATE Playlists SET tracks = ? WHERE id = ?"
-    cur.execute(sql, [tracks, playlist_id])
-    con.commit()
+    await add_track_to_playlist(playlist_id, track_id)
+    await keyboards.invalidate(("playlist", playlist_id))
+    await keyboards.invalidate(("user", query.from_user.id))
     callback_data.data = str(track_id)
     await cancel_adding_track_handler(query, callback_data)
 
 
-@dp.callback_query(Callback.filter(F.action == "page_add"))
+@router.callback_query(Callback.filter(F.action == "page_add"))
 async def change_page_handler(query: CallbackQuery, callback_data: Callback):
-    page, track_id = map(int, callback_data.data.split())
-    if callback_data.obj == "left":
-        page -= 1
-    else:
-        page += 1
-    playlists, markup, page_num = fetch_playlists_to_add(
-        query.from_user.id, track_id, page
+    track_id, page, anchor = callback_data.data.split()
+    playlists, markup, page_num = await fetch_playlists_to_add(
+        query.from_user.id, int(track_id), int(page), anchor
     )
     logo = InputMediaPhoto(
         media=library_img,
@@ -258,11 +357,10 @@ async def change_page_handler(query: CallbackQuery, callback_data: Callback):
     await query.message.edit_media(logo, reply_markup=markup)  # type: ignore
 
 
-@dp.callback_query(Callback.filter((F.action == "cancel") & (F.obj == "adding")))
+@router.callback_query(Callback.filter((F.action == "cancel") & (F.obj == "adding")))
 async def cancel_adding_track_handler(query: CallbackQuery, callback_data: Callback):
     track_id = int(callback_data.data)
-    sql = "SELECT title, artists, cover_link, yt_link FROM Tracks WHERE id = ?"
-    title, artists, cover_link, yt_link = cur.execute(sql, [track_id]).fetchone()
+    title, artists, cover_link, yt_link, _, cover_file_id = await get_track(track_id)
     keyboard = InlineKeyboardBuilder()
     keyboard.button(
         text="Download",
@@ -280,50 +378,44 @@ async def cancel_adding_track_handler(query: CallbackQuery, callback_data: Callb
     )
     keyboard.adjust(1, 1, 1)
     keyboard_markup = keyboard.as_markup()
-    cover = URLInputFile(cover_link, filename="cover.png")
     caption = html.link(f"{artists} - {title}", yt_link)
-    cover = InputMediaPhoto(
-        media=cover,
-        caption=caption,
+    await edit_track_cover(
+        query.message, track_id, cover_link, cover_file_id, caption, keyboard_markup
     )
-    await query.message.edit_media(cover, reply_markup=keyboard_markup)  # type: ignore
 
 
-@dp.callback_query(Callback.filter((F.action == "download") & (F.obj == "track")))
+@router.callback_query(Callback.filter((F.action == "download") & (F.obj == "track")))
 async def download_track_handler(query: CallbackQuery, callback_data: Callback):
     data = callback_data.data.split()
     track_id = int(data[0])
     playlist_id = None
     if len(data) != 1:
         playlist_id = int(data[1])
-    logo = InputMediaPhoto(
-        media=waiting_img,
-        caption=html.italic("Downloading..."),
+    title, artists, cover_link, yt_link, file_id, cover_file_id = await get_track(
+        track_id
     )
-    await query.message.edit_media(logo)  # type: ignore
-    filename = "track_" + str(
-        len([name for name in os.listdir("data/cache") if os.path.isfile(name)]) + 1
-    )
-    title, artists, cover_link, yt_link = cur.execute(
-        "SELECT title, artists, cover_link, yt_link FROM Tracks WHERE id = ?",
-        [track_id],
-    ).fetchone()
-    yt_dlp_opts = {
-        "format": "bestaudio/best",
-        "postprocessors": [
-            {
-                "key": "FFmpegExtractAudio",
-                "preferredcodec": "mp3",
-                "preferredquality": "192",
-            }
-        ],
-        "socket_timeout": 10,
-        "outtmpl": f"data/cache/{filename}",
-    }
-    with yt_dlp.YoutubeDL(yt_dlp_opts) as ydl:
+    if file_id is not None:
+        try:
+            await query.message.answer_audio(file_id)  # type: ignore
+        except TelegramBadRequest as e:
+            if not is_file_id_error(e):
+                raise
+            file_id = None
+            await set_track_file_id(track_id, None)
+            track_index.set_file_id(track_id, None)
+    if file_id is None:
+        logo = InputMediaPhoto(
+            media=waiting_img,
+            caption=html.italic("Downloading..."),
+        )
+        await query.message.edit_media(logo)  # type: ignore
         try:
-            ydl.download([yt_link])
-        except Exception:
+            async with downloader.fetch(track_id, yt_link) as path:
+                track = FSInputFile(path, f"{artists} - {title}")
+                msg = await query.message.answer_audio(track)  # type: ignore
+        except DownloadError:
+            # The video may be gone, its link is checked first thing
+            await flag_track_link(track_id)
             keyboard = InlineKeyboardBuilder()
             keyboard.button(
                 text="Try again",
@@ -337,20 +429,41 @@ async def download_track_handler(query: CallbackQuery, callback_data: Callback):
             )
             await query.message.edit_media(logo, reply_markup=keyboard_markup)  # type: ignore
             return
-    track = FSInputFile(f"data/cache/{filename}.mp3", f"{artists} - {title}")
-    cover = InputMediaPhoto(
-        media=URLInputFile(
-            cover_link,
-            filename="cover.png",
-        ),
-    )
-    await query.message.edit_media(cover)  # type: ignore
-    await query.message.answer_audio(track)  # type: ignore
+        await set_track_file_id(track_id, msg.audio.file_id)  # type: ignore
+        track_index.set_file_id(track_id, msg.audio.file_id)  # type: ignore
+    await edit_track_cover(query.message, track_id, cover_link, cover_file_id)
     if playlist_id:
-        logo, name = cur.execute(
-            "SELECT logo, name FROM Playlists WHERE id = ?", [playlist_id]
-        ).fetchone()
-        tracks, markup, _ = fetch_tracks(playlist_id, 0)
+        name, _, _ = await get_playlist(playlist_id)
+        tracks, markup, _ = await fetch_tracks(playlist_id, 0)
         caption = f"{html.bold(name)}\nTotal: {tracks}, Page: 1"
         await query.message.answer_photo(library_img, caption=caption, reply_markup=markup)  # type: ignore
-    os.remove(f"data/cache/{filename}.mp3")
+
+
+def inline_result(track):
+    # Downloaded tracks are sent as the audio itself, the others as a link
+    track_id, title, artists, cover_link, yt_link, file_id = track
+    if file_id is not None:
+        return InlineQueryResultCachedAudio(id=str(track_id), audio_file_id=file_id)
+    return InlineQueryResultArticle(
+        id=str(track_id),
+        title=title,
+        description=artists,
+        thumbnail_url=cover_link,
+        input_message_content=InputTextMessageContent(
+            message_text=html.link(f"{artists} - {title}", yt_link)
+        ),
+    )
+
+
+@router.inline_query()
+async def inline_search_handler(query: InlineQuery):
+    # Answered from the in-memory index only, nothing is searched remotely
+    if time.monotonic() - track_index.synced_at > INLINE_SYNC_INTERVAL:
+        await sync_track_index()
+    offset = int(query.offset or 0)
+    tracks, more = track_index.search(query.query, offset, INLINE_PAGE_SIZE)
+    await query.answer(
+        [inline_result(track) for track in tracks],
+        cache_time=INLINE_CACHE_TIME,
+        next_offset=str(offset + len(tracks)) if more else "",
+    )
@@ -0,0 +1,56 @@
+import asyncio
+import logging
+
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
+
+from .base import *
+from .metrics import metrics_handler
+
+
+class WebhookHandler(SimpleRequestHandler):
+    async def close(self):
+        # Updates are answered before they're handled, the ones already
+        # accepted get to finish before the bot session is closed
+        tasks = self._background_feed_update_tasks
+        if tasks:
+            logging.info("Waiting for %s updates to finish", len(tasks))
+            await asyncio.wait(tasks, timeout=WEBHOOK_SHUTDOWN_TIMEOUT)
+        await super().close()
+
+
+async def health_handler(request):
+    try:
+        await db.fetchone("SELECT 1")
+    except Exception as e:
+        logging.warning("Health check failed: %r", e)
+        return web.json_response({"status": "error"}, status=503)
+    return web.json_response(
+        {
+            "status": "ok",
+            "downloads_queued": downloader.queue_depth,
+            "downloads_active": downloader.active,
+        }
+    )
+
+
+async def set_webhook(app):
+    await bot.set_webhook(
+        WEBHOOK_URL + WEBHOOK_PATH,  # type: ignore
+        secret_token=WEBHOOK_SECRET,
+        allowed_updates=dp.resolve_used_update_types(),
+    )
+
+
+def create_app():
+    app = web.Application()
+    # The handler is registered first so its shutdown hook drains pending
+    # updates before the dispatcher stops the database and the downloader
+    WebhookHandler(dp, bot, secret_token=WEBHOOK_SECRET).register(
+        app, path=WEBHOOK_PATH
+    )
+    setup_application(app, dp, bot=bot)
+    app.on_startup.append(set_webhook)
+    app.router.add_get("/healthz", health_handler)
+    app.router.add_get("/metrics", metrics_handler)
+    return app
@@ -0,0 +1,215 @@
+import asyncio
+import logging
+from datetime import datetime
+from zoneinfo import ZoneInfo
+
+from .cache import MISSING, normalize_query
+from .downloads import pool_errors
+from .matching import video_scores
+from .metrics import EXTERNAL_SECONDS
+from .repository import exhaust_quota, refund_quota, reserve_quota
+
+VIDEO_URI = "https://www.youtube.com/watch?v="
+# Data API quota is counted in units and resets at midnight Pacific time
+SEARCH_COST = 100
+QUOTA_TIMEZONE = ZoneInfo("America/Los_Angeles")
+# Videos that can't be downloaded without an account
+UNAVAILABLE = ("needs_auth", "premium_only", "subscriber_only")
+# How YouTube says a video is gone, and how it says it's only refusing
+# this host for now (bot checks, captchas, rate limits). Both come as
+# expected yt-dlp errors, only the first kind makes a link dead.
+REMOVED_REASONS = (
+    "video unavailable",
+    "private video",
+    "this video is private",
+    "has been removed",
+    "no longer available",
+    "this video is not available",
+)
+TEMPORARY_REASONS = (
+    "not a bot",
+    "captcha",
+    "try again later",
+    "rate-limited",
+)
+
+
+class LinkCheckError(Exception):
+    pass
+
+
+def search_api(api, query, count):
+    # The search results of the Data API have no durations
+    videos = api.search(q=query, count=count, limit=count, return_json=True, search_type="video")["items"]  # type: ignore
+    return [(video["id"]["videoId"], video["snippet"]["title"], None) for video in videos]
+
+
+def search_ytdlp(query, count):
+    import yt_dlp
+
+    yt_dlp_opts = {
+        "extract_flat": True,
+        "socket_timeout": 10,
+        "quiet": True,
+    }
+    with yt_dlp.YoutubeDL(yt_dlp_opts) as ydl:
+        result = ydl.extract_info(f"ytsearch{count}:{query}", download=False)
+    videos = result.get("entries") or []  # type: ignore
+    return [(video["id"], video["title"], video.get("duration")) for video in videos]
+
+
+@pool_errors(LinkCheckError)
+def check_video(yt_link):
+    # Runs in a pool process. Fetches the video's metadata only, nothing is
+    # downloaded. Returns whether the video can still be downloaded, errors
+    # that don't say it was removed or blocked are raised as LinkCheckError.
+    import yt_dlp
+    from yt_dlp.utils import DownloadError, GeoRestrictedError
+
+    yt_dlp_opts = {
+        "socket_timeout": 10,
+        "quiet": True,
+        "no_warnings": True,
+    }
+    try:
+        with yt_dlp.YoutubeDL(yt_dlp_opts) as ydl:
+            info = ydl.extract_info(yt_link, download=False, process=False)
+    except DownloadError as e:
+        cause = e.exc_info[1] if e.exc_info else None
+        if isinstance(cause, GeoRestrictedError):
+            return False
+        message = str(e).lower()
+        if not any(reason in message for reason in TEMPORARY_REASONS) and any(
+            reason in message for reason in REMOVED_REASONS
+        ):
+            return False
+        raise
+    return info.get("availability") not in UNAVAILABLE  # type: ignore
+
+
+def is_quota_error(e):
+    from pyyoutube import PyYouTubeException
+
+    return (
+        isinstance(e, PyYouTubeException)
+        and e.status_code == 403
+        and "quota" in (e.message or "").lower()
+    )
+
+
+class LinkResolver:
+    # Finds the youtube video of a track. Links are cached by artists and
+    # title in cache, the videos found for a search query in search_cache.
+    # Searches return up to candidates videos, the one matching the track
+    # best is taken if it scores at least min_score. pyyoutube, yt-dlp and
+    # numpy are slow to import, they're loaded by the first search in the
+    # threads searches and scoring run in.
+    def __init__(
+        self,
+        api_key,
+        cache,
+        search_cache,
+        budget,
+        concurrency,
+        candidates=5,
+        min_score=60,
+        api_url=None,
+    ):
+        self.api_key = api_key
+        self.api_url = api_url
+        self._api = None
+        self.cache = cache
+        self.search_cache = search_cache
+        self.budget = budget
+        self.candidates = candidates
+        self.min_score = min_score
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.api_searches = 0
+        self.fallback_searches = 0
+
+    @property
+    def api(self):
+        if self._api is None:
+            from pyyoutube import Api
+
+            self._api = Api(api_key=self.api_key)
+            if self.api_url is not None:
+                self._api.BASE_URL = self.api_url
+        return self._api
+
+    async def resolve(self, title, artists, duration=None, dead=None):
+        # dead is a link of the track that stopped working, the track is
+        # searched for again and that video is left out
+        query = normalize_query(f"{artists} - {title}")
+        if dead is None:
+            yt_link = await self.cache.get(query)
+            if yt_link is not MISSING:
+                return yt_link
+        videos = await self.search(f"{artists} - {title}")
+        videos = [video for video in videos if VIDEO_URI + video[0] != dead]
+        track = (title, artists, duration)
+        scores = (await asyncio.to_thread(video_scores, [track], videos))[0]
+        yt_link = self.best_link(scores, videos)
+        if dead is None or yt_link is not None:
+            await self.cache.put(query, yt_link)
+        return yt_link
+
+    def best_link(self, scores, videos):
+        if not videos:
+            return None
+        best = int(scores.argmax())
+        if scores[best] < self.min_score:
+            return None
+        return VIDEO_URI + videos[best][0]
+
+    async def remember(self, title, artists, yt_link):
+        # Stores a link found by other means, so resolve doesn't search
+        await self.cache.put(normalize_query(f"{artists} - {title}"), yt_link)
+
+    async def search_videos(self, query):
+        # Videos found for what a user typed, with no result cached for a
+        # short time only in case the search failed
+        query = normalize_query(query)
+        videos = await self.search_cache.get(query)
+        if videos is MISSING:
+            videos = await self.search(query)
+            await self.search_cache.put(query, videos or None)
+        return [tuple(video) for video in videos or []]
+
+    def search_api(self, query):
+        # Runs in a thread, so is the first import of pyyoutube
+        return search_api(self.api, query, self.candidates)
+
+    async def search(self, query):
+        # Lookups wait for a free slot, use the Data API while the daily
+        # budget lasts and fall back to yt-dlp's search once it's spent
+        async with self.semaphore:
+            day = datetime.now(QUOTA_TIMEZONE).date().isoformat()
+            if await reserve_quota(day, SEARCH_COST, self.budget):
+                try:
+                    with EXTERNAL_SECONDS.time(
+                        service="youtube", operation="api_search"
+                    ):
+                        videos = await asyncio.to_thread(self.search_api, query)
+                except Exception as e:
+                    if is_quota_error(e):
+                        await exhaust_quota(day, self.budget)
+                    else:
+                        # The search wasn't made, an outage shouldn't use up
+                        # the day's budget
+                        await refund_quota(day, SEARCH_COST)
+                    logging.warning("YouTube Data API search failed: %s", e)
+                else:
+                    self.api_searches += 1
+                    return videos
+            self.fallback_searches += 1
+            try:
+                with EXTERNAL_SECONDS.time(
+                    service="youtube", operation="ytdlp_search"
+                ):
+                    return await asyncio.to_thread(
+                        search_ytdlp, query, self.candidates
+                    )
+            except Exception as e:
+                logging.warning("yt-dlp search failed: %s", e)
+                return []
@@ -2,15 +2,48 @@ import asyncio
 import logging
 import sys
 
-from handlers.base import *
-from handlers.playlists import *
-from handlers.tracks import *
+from handlers.startup import include_routers, profile_startup
 
 
 async def main():
+    from handlers.base import METRICS_PORT, WEBHOOK_HOST, bot, dp
+    from handlers.metrics import serve_metrics
+
+    if METRICS_PORT:
+        await serve_metrics(WEBHOOK_HOST, METRICS_PORT)
     await dp.start_polling(bot)
 
 
+def run():
+    # Everything is imported here, so --profile-startup can time the imports
+    from aiohttp import web
+
+    from handlers.base import (
+        WEBHOOK_HOST,
+        WEBHOOK_PORT,
+        WEBHOOK_SHUTDOWN_TIMEOUT,
+        WEBHOOK_URL,
+        dp,
+    )
+    from handlers.webhook import create_app
+
+    include_routers(dp)
+    if WEBHOOK_URL:
+        web.run_app(
+            create_app(),
+            host=WEBHOOK_HOST,
+            port=WEBHOOK_PORT,
+            reuse_port=True,
+            shutdown_timeout=WEBHOOK_SHUTDOWN_TIMEOUT,
+            print=logging.info,
+        )
+    else:
+        asyncio.run(main())
+
+
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO, stream=sys.stdout)
-    asyncio.run(main())
+    if "--profile-startup" in sys.argv[1:]:
+        profile_startup()
+    else:
+        run()